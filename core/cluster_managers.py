@@ -1,14 +1,44 @@
 # -*- coding: utf-8 -*-
 import logging
+import itertools
+import random
 from abc import ABCMeta, abstractmethod
+from array import array
+from operator import attrgetter
 from util import delta
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 """
 #TODO OPIS
 """
 
 
+_managers = {}
+
+
+def register_manager(cls):
+    """
+    Class decorator making the manager available
+    to the `manager` part setting.
+    """
+    _managers[cls.__name__] = cls
+    return cls
+
+
+def get_manager(name):
+    """
+    Return the registered manager class `name`.
+    """
+    if name not in _managers:
+        raise Exception('unknown cluster manager %s' % name)
+    return _managers[name]
+
+
 class _NodeSpace(object):
     """
 
@@ -22,6 +52,8 @@ class _NodeSpace(object):
         self.next = next
         self.job_ends = job_ends
         self.rsrv_starts = 0
+        # capacity change at the begin, the space is never merged
+        self.cap_change = 0
         self.update()
 
     def update(self):
@@ -34,6 +66,7 @@ class _NodeSpace(object):
             self.avail, self.reserved)
 
 
+@register_manager
 class BaseManager(object):
     """
 
@@ -45,6 +78,11 @@ class BaseManager(object):
 
     def __init__(self, cpus, settings):
         self._settings = settings
+        if settings.bf_policy not in ('conservative', 'easy'):
+            raise Exception('unknown backfilling policy %s'
+                            % settings.bf_policy)
+        self._easy = (settings.bf_policy == 'easy')
+        self._resolution = settings.bf_resolution
         self._space_list = _NodeSpace(
                     0,
                     float('inf'),
@@ -54,7 +92,10 @@ class BaseManager(object):
                     0,
                    )
         self._reservations = 0
+        # spaces split or reserved during the session
+        self._touched = []
         self._cpu_limit = cpus
+        self.window_reached = False
         self._debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
     def _dump_space(self, intro, *args):
@@ -71,7 +112,64 @@ class BaseManager(object):
         """
         TODO
         """
-        return job.proc <= self._cpu_limit
+        return self._width(job) <= self._cpu_limit
+
+    def set_capacity(self, changes):
+        """
+        Add the capacity timeline to the empty space list,
+        each <time, change> pair starts a new space.
+        The jobs wider than the final capacity are not runnable.
+        """
+        if self._easy:
+            raise Exception('capacity changes require'
+                            ' conservative backfilling')
+        it = self._space_list
+        assert it.next is None and not it.job_ends, 'manager in use'
+        avail = it.avail
+        for time, change in changes:
+            if not change:
+                continue
+            avail += change
+            if not 0 <= avail <= self._cpu_limit:
+                raise Exception('invalid capacity %s at %s' % (avail, time))
+            if time <= it.begin:
+                it.avail = avail
+                continue
+            new_space = _NodeSpace(time, it.end, avail, 0, None, 0)
+            new_space.cap_change = change
+            it.end = time
+            it.next = new_space
+            it.update()
+            it = new_space
+        # wider jobs could never start after the last change
+        self._cpu_limit = avail
+
+    def _move_head(self, now):
+        """
+        Move the head to `now`, dropping the spaces
+        that ended on a capacity change.
+        """
+        head = self._space_list
+        while head.end <= now and not head.job_ends:
+            head = self._space_list = head.next
+        head.begin = now
+        head.update()
+
+    def _width(self, job):
+        """
+        Return the number of CPUs the job blocks for other jobs.
+        """
+        return job.proc
+
+    def _round(self, time):
+        """
+        Round the planned job end up to the `bf_resolution` grid.
+        The hot paths inline it.
+        """
+        res = self._resolution
+        if not res:
+            return time
+        return -(-time // res) * res
 
     def start_session(self, now):
         """
@@ -82,8 +180,12 @@ class BaseManager(object):
 
         """
         self._window = now + self._settings.bf_window
-        self._space_list.begin = now
-        self._space_list.update()
+        self.window_reached = False
+        self._max_avail = None
+        # the EASY reservation
+        self._shadow = None
+        self._extra = 0
+        self._move_head(now)
         assert self._space_list.length > 0, 'some finished jobs not removed'
         assert not self._reservations, 'reservations not removed'
 
@@ -100,11 +202,15 @@ class BaseManager(object):
         """
         # The job spans the spaces from `first` to `last` (inclusive).
         # However we might have to split the last one.
-        if (last.end - first.begin) > job.time_limit:
+        end = first.begin + job.time_limit
+        res = self._resolution
+        if res:
+            end = -(-end // res) * res
+        if last.end > end:
             # Divide the `last` space appropriately and
             # create a new space to occupy the gap.
             new_space = _NodeSpace(
-                    first.begin + job.time_limit,
+                    end,
                     last.end,
                     last.avail,
                     last.reserved,
@@ -116,6 +222,8 @@ class BaseManager(object):
             last.next = new_space
             last.job_ends = 0
             last.update()
+            self._touched.append(last)
+            self._touched.append(new_space)
 
         if not reservation:
             last.job_ends += 1
@@ -124,11 +232,13 @@ class BaseManager(object):
             self._reservations += 1
 
         # remove the used up resources
+        proc = self._width(job)
         it = first
         while True:
-            it.avail -= job.proc
+            it.avail -= proc
             if reservation:
-                it.reserved += job.proc
+                it.reserved += proc
+                self._touched.append(it)
             if it == last:
                 break
             it = it.next
@@ -143,19 +253,26 @@ class BaseManager(object):
         assert not self._reservations, 'reservations are present'
         # In a space list without reservations, each space is
         # guaranteed to have more resources available than
-        # the spaces before them.
-        # This means we only have to check the first one
+        # the spaces before them, apart from the capacity drops.
+        # This means we usually only have to check the first one
         # to see if the job can be executed.
         first = self._space_list
-        if job.proc > first.avail:
+        proc = self._width(job)
+        if proc > first.avail:
             return False
 
         total_time = 0
         it = first
+        duration = job.time_limit
+        res = self._resolution
+        if res:
+            duration = -(-(first.begin + duration) // res) * res - first.begin
 
         while True:
+            if proc > it.avail:
+                return False  # only after a capacity drop
             total_time += it.length
-            if total_time >= job.time_limit:
+            if total_time >= duration:
                 last = it
                 break
             it = it.next
@@ -165,12 +282,73 @@ class BaseManager(object):
 
     def try_backfill(self, job):
         """
-        TODO
         Make a reservation for the job.
         Return if the job can be executed immediately.
         """
+        if self._easy:
+            return self._try_easy(job)
+        found = self._find_space(job, self._space_list)
+        if found is None:
+            return False
+        first, last = found
+        # check if the job can be executed now
+        can_run = (first == self._space_list)
+
+        self._allocate_resources(job, first, last, not can_run)
+        return can_run
+
+    def _try_easy(self, job):
+        """
+        EASY backfilling, only the first job that cannot start
+        gets a reservation. It is kept as the shadow time (the job
+        start) and the extra CPUs (not needed by the job then).
+        Other jobs can start if they end before the shadow time
+        or use only the extra CPUs.
+        """
+        head = self._space_list
+        proc = self._width(job)
+        if proc > head.avail:
+            if self._shadow is None:
+                found = self._find_space(job, head)
+                if found is None:
+                    self._shadow = float('inf')
+                else:
+                    first, _ = found
+                    self._shadow = first.begin
+                    # the profile is not decreasing without reservations
+                    self._extra = first.avail - proc
+            return False
+
+        if self._shadow is not None:
+            end = self._round(head.begin + job.time_limit)
+            if end > self._shadow:
+                if proc > self._extra:
+                    return False
+                self._extra -= proc
+        scheduled = BaseManager.try_schedule(self, job)
+        assert scheduled, 'invalid profile'
+        return True
+
+    def _find_space(self, job, first):
+        """
+        Find the earliest spaces, starting from `first`, that can
+        hold the job. Return the first and the last one or `None`
+        if the job cannot start inside the backfilling window.
+        """
+        proc = self._width(job)
+        if self._max_avail is None:
+            self._max_avail = self._window_max_avail()
+        if proc > self._max_avail or first.begin > self._window:
+            # no space in the window to start the job
+            self.window_reached = True
+            return None
+
         total_time = 0
-        it = first = self._space_list
+        it = first
+        duration = job.time_limit
+        res = self._resolution
+        if res:
+            duration = -(-(first.begin + duration) // res) * res - first.begin
 
         avail = it.avail
         must_check = True
@@ -179,85 +357,189 @@ class BaseManager(object):
             if must_check:
                 avail = min(avail, it.avail)
 
-            if not must_check or job.proc <= avail:
+            if not must_check or proc <= avail:
                 total_time += it.length
-                if total_time >= job.time_limit:
+                if total_time >= duration:
                     last = it
                     break
                 # next space #TODO OPIS (dlaczego tak sie sprawdza must_check??)
                 it = it.next
-                must_check = it.rsrv_starts > 0
+                must_check = it.rsrv_starts > 0 or it.cap_change < 0
             else:
                 total_time = 0
+                if first.next is None:
+                    return None  # the end of the profile
                 #TODO OPIS
                 it = first = first.next
+                if res:
+                    duration = (-(-(first.begin + job.time_limit) // res) * res
+                                - first.begin)
                 avail = it.avail
                 must_check = True
                 # Maybe we can stop, if the potential start is already
                 # outside of the backfilling window.
                 if first.begin > self._window:
-                    return False
+                    self.window_reached = True
+                    return None
 
-        # check if the job can be executed now
-        can_run = (first == self._space_list)
+        return first, last
 
-        self._allocate_resources(job, first, last, not can_run)
-        return can_run
+    def try_backfill_batch(self, jobs):
+        """
+        Make the `try_backfill` calls for the jobs in the given
+        order, until there are no free resources. Requires numpy.
+        Return the results for the tried jobs.
+
+        The space list is mirrored in arrays, so the earliest
+        start for each job is found with vectorized prefix sums.
+        The allocations are still made on the space list.
+        """
+        spaces = []
+        it = self._space_list
+        while it is not None:
+            spaces.append(it)
+            it = it.next
+        begins = numpy.array([sp.begin for sp in spaces], dtype=numpy.int64)
+        avail = numpy.array([sp.avail for sp in spaces], dtype=numpy.int64)
+
+        if self._easy:
+            # each job is already checked in a constant time
+            results = []
+            for job in jobs:
+                if not self._space_list.avail:
+                    break
+                results.append(self.try_backfill(job))
+            return results
+
+        results = []
+        for job in jobs:
+            if not avail[0]:
+                break  # nothing can start anymore
+            proc = self._width(job)
+            # the starts inside the window and the last spaces
+            count = numpy.searchsorted(begins, self._window, 'right')
+            ends = self._round(begins[:count] + job.time_limit)
+            last = numpy.searchsorted(begins, ends, 'left') - 1
+            # the number of too small spaces before each space
+            short = numpy.zeros(len(spaces) + 1, dtype=numpy.int64)
+            numpy.cumsum(avail < proc, out=short[1:])
+            fits = numpy.flatnonzero(short[last + 1] == short[:count])
+            if not len(fits):
+                self.window_reached = True
+                results.append(False)
+                continue
+
+            i = fits[0]
+            j = last[i]
+            after = spaces[j + 1] if j + 1 < len(spaces) else None
+            can_run = (i == 0)
+            self._allocate_resources(job, spaces[i], spaces[j], not can_run)
+            if spaces[j].next is not after:
+                # the last space was split
+                spaces.insert(j + 1, spaces[j].next)
+                begins = numpy.insert(begins, j + 1, spaces[j].end)
+                avail = numpy.insert(avail, j + 1, avail[j])
+            avail[i:j + 1] -= proc
+            results.append(can_run)
+        return results
+
+    def _window_max_avail(self):
+        """
+        Return the maximum available resources among the spaces
+        starting in the backfilling window.
+
+        The reservations only lower the resources, so the value
+        stays an upper bound for the whole session.
+        """
+        best = 0
+        it = self._space_list
+        while it is not None and it.begin <= self._window:
+            best = max(best, it.avail)
+            it = it.next
+        return best
 
     def end_session(self):
         """
-        #TODO
         Clear the created reservations.
+
+        Only the spaces touched during the session are cleared.
+        Going back in time, each space without job ends absorbs
+        the (already cleared) next space.
         """
         before = self._reservations
-        prev, it = None, self._space_list
+        touched = set(self._touched)
+        self._touched = []
 
-        while it.next is not None:
+        for it in sorted(touched, key=attrgetter('begin'), reverse=True):
             # update the count
             self._reservations -= it.rsrv_starts
             it.rsrv_starts = 0
+            it.avail += it.reserved
+            it.reserved = 0
             # now clean up
-            if not it.job_ends:
-                # we can safely remove this space
-                remove, it = it, it.next
-                it.begin = remove.begin
+            if (not it.job_ends and it.next is not None and
+                    not it.next.cap_change):
+                # we can safely merge this space with the next one
+                remove = it.next
+                assert it.avail == remove.avail, 'invalid split space'
+                it.end = remove.end
+                it.reserved = remove.reserved
+                it.job_ends = remove.job_ends
                 it.update()
-                #TODO DODAC JAKIES ASSERTY??
-                #TODO WYGLADA NA TO ZE REMOVE.AVAIL + REMOVE.RESERVED == IT.AVAIL??
-                prev.next = it
+                # move 'pointers' as the last step
+                it.next = remove.next
                 remove.next = None
-            else:
-                it.avail += it.reserved
-                it.reserved = 0
-                prev, it = it, it.next
 
         assert not self._reservations, 'reservations not cleared'
         if self._debug:
+            self._verify_spaces()
             self._dump_space('Cleared %s reservations', before)
 
+    def _verify_spaces(self):
+        """
+        Check the whole space list is in the state
+        expected outside of a session.
+        """
+        it = self._space_list
+        while it is not None:
+            assert not it.reserved and not it.rsrv_starts, \
+                'reservation not cleared %s' % it
+            if it.next is not None:
+                fixed = it.next.cap_change
+                assert it.job_ends > 0 or fixed, 'space not merged %s' % it
+                assert it.end == it.next.begin, 'broken space list'
+                assert it.avail <= it.next.avail or fixed, \
+                    'invalid resources'
+            else:
+                assert it.end == float('inf'), 'invalid last space'
+            it = it.next
+
     def job_ended(self, job):
         """
         #TODO
         Free the resources taken by the job.
         """
         assert not self._reservations, 'reservations are present'
-        self._space_list.begin = job.end_time
-        self._space_list.update()
+        self._move_head(job.end_time)
         assert self._space_list.length >= 0, 'some finished jobs not removed'
         #assert job.alloc is not None, 'missing job resources'
         #TODO TEN ASSERT TERAZ POWINIEN SPRAWDZAC CZY PRACA JEST JUZ FINISHED (STARTED?)
 
         last_space_end = job.start_time + job.time_limit
+        res = self._resolution
+        if res:
+            last_space_end = -(-last_space_end // res) * res
+        proc = self._width(job)
         it = self._space_list
 
         while it.end < last_space_end:
-            it.avail += job.proc
+            it.avail += proc
             it = it.next
 
         assert it.end == last_space_end, 'missing job last space'
         assert it.job_ends > 0, 'invalid last space'
 
-        if it.job_ends == 1:
+        if it.job_ends == 1 and not it.next.cap_change:
             # we can safely merge this space with the next one
             remove = it.next
             it.end = remove.end
@@ -270,8 +552,718 @@ class BaseManager(object):
             it.next = remove.next
             remove.next = None
         else:
-            it.avail += job.proc
+            it.avail += proc
             it.job_ends -= 1
 
         if self._debug:
             self._dump_space('Removed resources %s', job)
+
+
+@register_manager
+class PersistentManager(BaseManager):
+    """
+    Conservative backfilling keeping the reservations between
+    the passes. The reservations are made in the priority order,
+    so a pass reuses them as long as the tried jobs follow the plan.
+
+    The plan is cut at the first job out of order (a new higher
+    priority job, a priority or estimate change) and dropped when
+    the profile changes, i.e. on an early job end or a job
+    started by the main pass.
+    """
+
+    def __init__(self, cpus, settings):
+        BaseManager.__init__(self, cpus, settings)
+        if self._easy:
+            raise Exception('PersistentManager supports only'
+                            ' the conservative policy')
+        # (job, first space, begin, end, cpus) in the priority order
+        self._plan = []
+        self._cursor = 0
+        self._backfill = False
+        self._now = 0
+
+    def start_session(self, now):
+        self._window = now + self._settings.bf_window
+        self.window_reached = False
+        self._max_avail = None
+        self._now = now
+        self._cursor = 0
+        self._backfill = False
+        self._cut_late(now)
+        self._move_head(now)
+        assert self._space_list.length > 0, 'some finished jobs not removed'
+
+    def _cut_late(self, now):
+        """
+        Cut the plan at the first reservation that should have
+        started before `now`. A reservation can start when another
+        one ends, which is not a simulator event.
+        """
+        for i, entry in enumerate(self._plan):
+            if entry[2] < now:
+                self._cut_plan(i)
+                break
+
+    def try_schedule(self, job):
+        head = self._space_list
+        # the main pass does not see the reservations
+        if self._width(job) > head.avail + head.reserved:
+            return False
+        self._cut_plan(0)
+        return BaseManager.try_schedule(self, job)
+
+    def try_backfill(self, job):
+        self._backfill = True
+        if self._cursor < len(self._plan):
+            entry = self._plan[self._cursor]
+            if entry[0] is job and entry[2] >= self._now:
+                if entry[2] > self._now:
+                    # nothing before it changed, same start
+                    self._cursor += 1
+                    return False
+                self._start_reserved(entry)
+                del self._plan[self._cursor]
+                return True
+            self._cut_plan(self._cursor)
+
+        found = self._find_space(job, self._space_list)
+        if found is None:
+            return False
+        first, last = found
+        can_run = (first == self._space_list)
+        self._allocate_resources(job, first, last, not can_run)
+        if not can_run:
+            end = self._round(first.begin + job.time_limit)
+            self._plan.append((job, first, first.begin,
+                               end, self._width(job)))
+            self._cursor += 1
+        return can_run
+
+    def try_backfill_batch(self, jobs):
+        """
+        The plan is already reused, so the jobs are tried one by one.
+        """
+        results = []
+        for job in jobs:
+            head = self._space_list
+            if not head.avail + head.reserved:
+                break
+            results.append(self.try_backfill(job))
+        return results
+
+    def _start_reserved(self, entry):
+        """
+        Turn the reservation starting now into the job allocation.
+        """
+        job, first, begin, end, proc = entry
+        assert first is self._space_list, 'reservation not at the head'
+        first.rsrv_starts -= 1
+        it = first
+        while True:
+            it.reserved -= proc
+            if it.end == end:
+                break
+            it = it.next
+        it.job_ends += 1
+        self._reservations -= 1
+
+    def _cut_plan(self, index):
+        """
+        Release the reservations from the plan `index` onward.
+        """
+        if index >= len(self._plan):
+            return
+        for job, first, begin, end, proc in self._plan[index:]:
+            first.rsrv_starts -= 1
+            it = first
+            while True:
+                it.avail += proc
+                it.reserved -= proc
+                if it.end == end:
+                    break
+                it = it.next
+        self._reservations -= len(self._plan) - index
+        del self._plan[index:]
+        # the released resources invalidate the bound
+        self._max_avail = None
+
+        # Merge the spaces left without a boundary. The first space
+        # of a reservation is kept, the last one ends where the
+        # resources change, so the plan references stay valid.
+        it = self._space_list
+        while it.next is not None:
+            remove = it.next
+            if (it.job_ends or remove.rsrv_starts or remove.cap_change or
+                    it.avail != remove.avail):
+                it = remove
+                continue
+            assert it.reserved == remove.reserved, 'invalid split space'
+            it.end = remove.end
+            it.job_ends = remove.job_ends
+            it.update()
+            it.next = remove.next
+            remove.next = None
+
+    def end_session(self):
+        """
+        Keep the reservations, apart from the jobs
+        not tried in this backfilling pass.
+        """
+        if self._backfill:
+            self._cut_plan(self._cursor)
+        self._touched = []
+        if self._debug:
+            self._dump_space('Kept %s reservations', self._reservations)
+
+    def job_ended(self, job):
+        on_time = (self._round(job.start_time + job.time_limit)
+                   == job.end_time)
+        if not on_time:
+            # earlier starts are possible now
+            self._cut_plan(0)
+        self._cut_late(job.end_time)
+        if not self._plan:
+            BaseManager.job_ended(self, job)
+            return
+
+        # The job ends with its last space, so the head is empty now.
+        # It is dropped instead of merged, to keep the next space
+        # begin if a reservation starts there.
+        self._move_head(job.end_time)
+        head = self._space_list
+        assert head.length == 0 and head.job_ends > 0, 'invalid job end'
+        head.avail += self._width(job)
+        head.job_ends -= 1
+        if not head.job_ends:
+            self._space_list = head.next
+            head.next = None
+
+        if self._debug:
+            self._dump_space('Removed resources %s', job)
+
+
+@register_manager
+class NodeManager(BaseManager):
+    """
+    A manager placing the jobs on nodes with `node_cores` CPUs each.
+
+    The availability profile is kept as in the `BaseManager`
+    with the CPUs blocked by each job, while the nodes decide
+    if the job can actually start now.
+
+    Placement:
+      With `node_exclusive` each job takes whole nodes.
+      Otherwise it takes whole nodes for each full `node_cores`
+      CPUs and the rest from a single node (best fit).
+
+    The free CPUs of each node are kept in an array and the
+    nodes are indexed by the free CPU count, so the placement
+    does not depend on the number of nodes.
+    """
+
+    def __init__(self, cpus, settings):
+        BaseManager.__init__(self, cpus, settings)
+        if self._easy:
+            raise Exception('NodeManager supports only'
+                            ' conservative backfilling')
+        self._cores = settings.node_cores
+        if self._cores <= 0 or cpus % self._cores:
+            raise Exception('%s CPUs cannot be split into nodes with %s'
+                            ' cores' % (cpus, self._cores))
+        nodes = cpus // self._cores
+        self._free = array('i', [self._cores] * nodes)
+        # nodes by the number of free CPUs
+        self._buckets = [set() for _ in xrange(self._cores + 1)]
+        self._buckets[self._cores].update(xrange(nodes))
+        self._allocs = {}
+
+    def set_capacity(self, changes):
+        raise Exception('NodeManager does not support capacity changes')
+
+    def _width(self, job):
+        if self._settings.node_exclusive:
+            return -(-job.proc // self._cores) * self._cores
+        return job.proc
+
+    def _place(self, job):
+        """
+        Return the <node, CPUs> pairs for the job
+        or `None` if it does not fit now.
+        """
+        full, rest = divmod(self._width(job), self._cores)
+        idle = self._buckets[self._cores]
+        if len(idle) < full:
+            return None
+        nodes = itertools.islice(idle, full)
+        alloc = [(node, self._cores) for node in nodes]
+        if rest:
+            # the best fit for the remaining CPUs
+            for count in xrange(rest, self._cores):
+                if self._buckets[count]:
+                    node = next(iter(self._buckets[count]))
+                    break
+            else:
+                if len(idle) == full:
+                    return None
+                node = next(itertools.islice(idle, full, None))
+            alloc.append((node, rest))
+        return alloc
+
+    def _move(self, node, change):
+        free = self._free[node]
+        self._buckets[free].remove(node)
+        self._buckets[free + change].add(node)
+        self._free[node] = free + change
+
+    def _commit(self, job, alloc):
+        for node, count in alloc:
+            self._move(node, -count)
+        self._allocs[job] = alloc
+
+    def try_schedule(self, job):
+        alloc = self._place(job)
+        if alloc is None:
+            return False
+        # the placement implies enough CPUs in the profile
+        scheduled = BaseManager.try_schedule(self, job)
+        assert scheduled, 'invalid profile'
+        self._commit(job, alloc)
+        return True
+
+    def try_backfill(self, job):
+        found = self._find_space(job, self._space_list)
+        if found is None:
+            return False
+        first, last = found
+        alloc = None
+        if first == self._space_list:
+            alloc = self._place(job)
+            if alloc is None and first.next is not None:
+                # the nodes are too fragmented, plan the job later
+                found = self._find_space(job, first.next)
+                if found is None:
+                    return False
+                first, last = found
+            elif alloc is None:
+                return False
+
+        can_run = alloc is not None
+        self._allocate_resources(job, first, last, not can_run)
+        if can_run:
+            self._commit(job, alloc)
+        return can_run
+
+    def try_backfill_batch(self, jobs):
+        # The simulator counts the requested CPUs, which can be more
+        # than the free CPUs here. All the jobs are tried, the jobs
+        # after the simulator stops can only get reservations.
+        return [self.try_backfill(job) for job in jobs]
+
+    def job_ended(self, job):
+        BaseManager.job_ended(self, job)
+        for node, count in self._allocs.pop(job):
+            self._move(node, count)
+
+
+class _ProfileNode(object):
+    """
+    A treap node, the resources available from `key`
+    until the next key.
+    """
+
+    __slots__ = ('key', 'avail', 'prio', 'left', 'right',
+                 'low', 'high', 'lazy')
+
+    def __init__(self, key, avail, prio):
+        self.key = key
+        self.avail = avail
+        self.prio = prio
+        self.left = self.right = None
+        self.low = self.high = avail
+        self.lazy = 0
+
+
+def _apply(node, value):
+    if node is not None:
+        node.avail += value
+        node.low += value
+        node.high += value
+        node.lazy += value
+
+
+def _push(node):
+    if node.lazy:
+        _apply(node.left, node.lazy)
+        _apply(node.right, node.lazy)
+        node.lazy = 0
+
+
+def _pull(node):
+    low = high = node.avail
+    if node.left is not None:
+        low = min(low, node.left.low)
+        high = max(high, node.left.high)
+    if node.right is not None:
+        low = min(low, node.right.low)
+        high = max(high, node.right.high)
+    node.low, node.high = low, high
+
+
+def _split(node, key, inclusive=False):
+    """
+    Split the treap into the keys before `key` and the rest.
+    With `inclusive` the `key` goes to the first part.
+    """
+    if node is None:
+        return None, None
+    _push(node)
+    if node.key < key or (inclusive and node.key == key):
+        node.right, right = _split(node.right, key, inclusive)
+        _pull(node)
+        return node, right
+    else:
+        left, node.left = _split(node.left, key, inclusive)
+        _pull(node)
+        return left, node
+
+
+def _merge(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio > b.prio:
+        _push(a)
+        a.right = _merge(a.right, b)
+        _pull(a)
+        return a
+    else:
+        _push(b)
+        b.left = _merge(a, b.left)
+        _pull(b)
+        return b
+
+
+def _first_below(node, key, value):
+    """
+    Find the first node from `key` with less than `value` available.
+    """
+    if node is None or node.low >= value:
+        return None
+    _push(node)
+    if node.key < key:
+        return _first_below(node.right, key, value)
+    found = _first_below(node.left, key, value)
+    if found is not None:
+        return found
+    if node.avail < value:
+        return node
+    return _first_below(node.right, key, value)
+
+
+def _first_at_least(node, key, value):
+    """
+    Find the first node from `key` with at least `value` available.
+    """
+    if node is None or node.high < value:
+        return None
+    _push(node)
+    if node.key < key:
+        return _first_at_least(node.right, key, value)
+    found = _first_at_least(node.left, key, value)
+    if found is not None:
+        return found
+    if node.avail >= value:
+        return node
+    return _first_at_least(node.right, key, value)
+
+
+class _Profile(object):
+    """
+    The resource availability over time as a treap of breakpoints,
+    with range updates and range queries in logarithmic time.
+    """
+
+    def __init__(self, key, avail):
+        self._random = random.Random(key)
+        self._root = self._node(key, avail)
+
+    def _node(self, key, avail):
+        return _ProfileNode(key, avail, self._random.random())
+
+    def _find(self, key):
+        """
+        Return the node with the greatest key not after `key`.
+        """
+        node, best = self._root, None
+        while node is not None:
+            _push(node)
+            if node.key <= key:
+                best, node = node, node.right
+            else:
+                node = node.left
+        return best
+
+    def avail(self, key):
+        return self._find(key).avail
+
+    def insert(self, key):
+        """
+        Add a breakpoint at `key`, the resources are unchanged.
+        """
+        prev = self._find(key)
+        if prev.key == key:
+            return
+        left, right = _split(self._root, key)
+        new = self._node(key, prev.avail)
+        self._root = _merge(_merge(left, new), right)
+
+    def remove(self, key):
+        left, right = _split(self._root, key)
+        mid, right = _split(right, key, inclusive=True)
+        assert mid is not None, 'missing breakpoint'
+        self._root = _merge(left, right)
+
+    def drop_before(self, key):
+        _, self._root = _split(self._root, key)
+
+    def add(self, begin, end, value):
+        """
+        Change the resources from `begin` until `end` by `value`.
+        Both must be breakpoints.
+        """
+        left, right = _split(self._root, begin)
+        mid, right = _split(right, end)
+        _apply(mid, value)
+        self._root = _merge(_merge(left, mid), right)
+
+    def max_between(self, begin, end):
+        """
+        Return the maximum resources among the breakpoints
+        from `begin` to `end` (inclusive).
+        """
+        left, right = _split(self._root, begin)
+        mid, right = _split(right, end, inclusive=True)
+        best = mid.high if mid is not None else 0
+        self._root = _merge(_merge(left, mid), right)
+        return best
+
+    def first_below(self, key, value):
+        node = _first_below(self._root, key, value)
+        return node and node.key
+
+    def first_at_least(self, key, value):
+        node = _first_at_least(self._root, key, value)
+        return node and node.key
+
+    def __iter__(self):
+        """
+        Iterate over the <key, avail> pairs in the time order.
+        """
+        stack, node = [], self._root
+        while stack or node is not None:
+            if node is not None:
+                _push(node)
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                yield node.key, node.avail
+                node = node.right
+
+
+@register_manager
+class TreeManager(BaseManager):
+    """
+    A manager with the same behaviour as the `BaseManager`,
+    but with the availability profile stored in a treap.
+    Each operation takes a logarithmic time in the number
+    of distinct job ends, instead of a linear one.
+    """
+
+    def __init__(self, cpus, settings):
+        self._settings = settings
+        if settings.bf_policy != 'conservative':
+            raise Exception('TreeManager supports only'
+                            ' conservative backfilling')
+        self._resolution = settings.bf_resolution
+        self._profile = _Profile(0, cpus)
+        self._head = 0
+        # the number of running jobs ending at each breakpoint
+        self._job_ends = {}
+        # breakpoints of the capacity changes
+        self._cap_changes = set()
+        self._rsrv_list = []
+        self._reservations = 0
+        self._cpu_limit = cpus
+        self.window_reached = False
+        self._debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    def _dump_space(self, intro, *args):
+        logging.debug(intro, *args)
+        for key, avail in self._profile:
+            logging.debug('[%s] avail %s ends %s', delta(key), avail,
+                          self._job_ends.get(key, 0))
+
+    def set_capacity(self, changes):
+        """
+        Each change is a breakpoint and a suffix update
+        of the profile, done in a logarithmic time.
+        """
+        avail = self._cpu_limit
+        for time, change in changes:
+            if not change:
+                continue
+            avail += change
+            if not 0 <= avail <= self._cpu_limit:
+                raise Exception('invalid capacity %s at %s' % (avail, time))
+            time = max(time, self._head)
+            self._profile.insert(time)
+            self._profile.add(time, float('inf'), change)
+            self._cap_changes.add(time)
+        # wider jobs could never start after the last change
+        self._cpu_limit = avail
+
+    def _move_head(self, now):
+        assert now >= self._head, 'time going backwards'
+        if now > self._head:
+            self._profile.insert(now)
+            self._profile.drop_before(now)
+            self._head = now
+
+    def start_session(self, now):
+        self._window = now + self._settings.bf_window
+        self.window_reached = False
+        self._max_avail = None
+        self._move_head(now)
+        assert not self._reservations, 'reservations not removed'
+
+    def _allocate(self, job, begin, reservation):
+        end = self._round(begin + job.time_limit)
+        self._profile.insert(end)
+        self._profile.add(begin, end, -job.proc)
+        if not reservation:
+            self._job_ends[end] = self._job_ends.get(end, 0) + 1
+        else:
+            self._rsrv_list.append((begin, end, job.proc))
+            self._reservations += 1
+
+        if self._debug:
+            self._dump_space('Added resources %s', job)
+
+    def try_schedule(self, job):
+        assert not self._reservations, 'reservations are present'
+        # Without reservations the head has the least resources,
+        # apart from the capacity drops.
+        bad = self._profile.first_below(self._head, job.proc)
+        if bad is not None and bad < self._round(self._head + job.time_limit):
+            return False
+        self._allocate(job, self._head, False)
+        return True
+
+    def try_backfill(self, job):
+        if self._max_avail is None:
+            self._max_avail = self._profile.max_between(self._head,
+                                                        self._window)
+        if job.proc > self._max_avail:
+            self.window_reached = True
+            return False
+
+        begin = self._head
+        while True:
+            # jump over the spaces before the first
+            # one with not enough resources
+            bad = self._profile.first_below(begin, job.proc)
+            if bad is None or bad >= self._round(begin + job.time_limit):
+                break
+            begin = self._profile.first_at_least(bad, job.proc)
+            if begin is None:
+                return False  # the end of the profile
+            if begin > self._window:
+                self.window_reached = True
+                return False
+
+        can_run = (begin == self._head)
+        self._allocate(job, begin, not can_run)
+        return can_run
+
+    def try_backfill_batch(self, jobs):
+        # the profile queries are already logarithmic
+        results = []
+        for job in jobs:
+            if not self._profile.avail(self._head):
+                break
+            results.append(self.try_backfill(job))
+        return results
+
+    def end_session(self):
+        before = self._reservations
+        points = set()
+        for begin, end, proc in self._rsrv_list:
+            self._profile.add(begin, end, proc)
+            points.add(begin)
+            points.add(end)
+        # only the job ends, capacity changes and the head stay
+        for key in points:
+            if (key != self._head and key not in self._job_ends and
+                    key not in self._cap_changes):
+                self._profile.remove(key)
+        self._rsrv_list = []
+        self._reservations = 0
+
+        if self._debug:
+            self._dump_space('Cleared %s reservations', before)
+
+    def job_ended(self, job):
+        assert not self._reservations, 'reservations are present'
+        self._move_head(job.end_time)
+        end = self._round(job.start_time + job.time_limit)
+        assert self._job_ends.get(end), 'missing job last space'
+        self._profile.add(self._head, end, job.proc)
+
+        self._job_ends[end] -= 1
+        if not self._job_ends[end]:
+            del self._job_ends[end]
+            if end != self._head and end not in self._cap_changes:
+                self._profile.remove(end)
+
+        if self._debug:
+            self._dump_space('Removed resources %s', job)
+
+
+@register_manager
+class CounterManager(BaseManager):
+    """
+    A manager that only counts the free CPUs, without any
+    availability profile. Supports only runs without backfilling.
+    """
+
+    def __init__(self, cpus, settings):
+        if settings.bf_depth:
+            raise Exception('CounterManager requires bf_depth 0')
+        self._settings = settings
+        self._free = cpus
+        self._cpu_limit = cpus
+        self.window_reached = False
+
+    def set_capacity(self, changes):
+        raise Exception('CounterManager does not support capacity changes')
+
+    def start_session(self, now):
+        pass
+
+    def try_schedule(self, job):
+        if job.proc > self._free:
+            return False
+        self._free -= job.proc
+        return True
+
+    def try_backfill(self, job):
+        raise Exception('backfilling not supported')
+
+    def end_session(self):
+        pass
+
+    def job_ended(self, job):
+        self._free += job.proc
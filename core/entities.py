@@ -14,6 +14,7 @@ class Job(object):
       run_time: job execution time.
       estimate: job run time estimate set by the scheduler.
       time_limit: job time limit (>= run time) set by the owner.
+      partition: partition the job was submitted to.
       start_time: execution start time.
       end_time: execution end time.
       started: job state.
@@ -28,7 +29,7 @@ class Job(object):
     """
 
     __slots__ = ('ID', 'submit', 'run_time', 'proc', 'user', 'time_limit',
-                 'camp', '_start', '_completed', 'estimate')
+                 'partition', 'camp', '_start', '_completed', 'estimate')
 
     def __init__(self, stats, user):
         self.ID = stats['job_id']
@@ -37,6 +38,7 @@ class Job(object):
         self.proc = stats['proc']
         self.user = user
         self.time_limit = stats['time_limit']
+        self.partition = stats['partition']
 
     def reset(self):
         self.camp = None
@@ -167,7 +169,10 @@ class User(object):
       ID: user ID, globally unique.
       shares: **NORMALIZED** share of the resources.
       active: state in the virtual schedule.
-      cpu_clock_used: total usage, already accounting the decay.
+      cpu_clock_used: total usage in the decay epoch coordinates,
+                      multiply by the simulator `usage_scale` to get
+                      the value with the decay applied.
+      occupied_cpus: number of CPUs used by the running jobs.
       active_jobs: not finished jobs (pending or running).
       completed_jobs: jobs that finished execution, ordered by end time.
       active_camps: active campaigns (see `Campaign`), ordered by creation time.
@@ -216,9 +221,14 @@ class User(object):
         self._virt_pool = 0
         self.lost_virtual += total
 
+    @property
+    def occupied_cpus(self):
+        return self._occupied_cpus
+
     def real_work(self, value):
         """
         Process the `value` long period in the real schedule.
+        The period is in the decay epoch coordinates.
         """
         self.cpu_clock_used += self._occupied_cpus * value
 
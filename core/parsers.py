@@ -24,6 +24,34 @@ def get_parser(filename):
     return p
 
 
+def parse_capacity(filename):
+    """
+    Parse a capacity timeline file. Each line holds:
+      time down|up cpus [partition]
+
+    Lines starting with '#' are skipped.
+    Return a dictionary with the sorted <time, change> pairs
+    for each partition (`None` if not given).
+    """
+    timeline = {}
+    f = open(filename)
+    for line in f:
+        values = line.split()
+        if not values or values[0].startswith('#'):
+            continue
+        if len(values) not in (3, 4) or values[1] not in ('down', 'up'):
+            raise Exception('invalid capacity change %s' % line.strip())
+        time, cpus = int(values[0]), int(values[2])
+        if values[1] == 'down':
+            cpus = -cpus
+        partition = int(values[3]) if len(values) == 4 else None
+        changes = timeline.setdefault(partition, {})
+        changes[time] = changes.get(time, 0) + cpus
+    f.close()
+    return {p: sorted(changes.iteritems())
+            for p, changes in timeline.iteritems()}
+
+
 class BaseParser(object):
     """
     Base class for reading and parsing different workload files.
@@ -32,7 +60,7 @@ class BaseParser(object):
     __metaclass__ = ABCMeta
 
     REQUIRED = ['job_id', 'submit', 'run_time', 'proc', 'user_id']
-    OPTIONAL = ['time_limit']
+    OPTIONAL = ['time_limit', 'partition']
 
     def parse_workload(self, filename, serial):
         """
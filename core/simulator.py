@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import bisect
 import heapq
 import itertools
 import logging
@@ -6,7 +7,8 @@ import math
 import time
 import zlib
 import cluster_managers
-from util import delta
+import waiting_queues
+from util import delta, IndexedHeap, MinMultiset
 
 
 class Events(object):
@@ -17,36 +19,162 @@ class Events(object):
     new_job = 1
     job_end = 2
     estimate_end = 3
-    bf_run = 4
-    campaign_end = 5
-    force_decay = 6
+    sched_run = 4
+    capacity_change = 5
+    bf_run = 6
+    campaign_end = 7
+    force_decay = 8
 
 
 class PriorityQueue(object):
     """
     A priority queue of <time, event, entity>, ordered by time.
     Ties are ordered by the `Events` value.
+
+    Each <event, entity> pair can be present only once in the queue.
+    Adding it again moves the existing event to the new time and
+    a removed event is taken out of the queue immediately,
+    so the queue size is bounded by the number of live events.
+
+    Attributes:
+      peak: the maximum number of events in the queue.
+      dropped: the number of events that were moved or removed
+               before they could be processed.
     """
-    _REMOVED = 'removed-event'
 
     def __init__(self):
-        self._pq = []
+        self._heap = IndexedHeap()
+        self._counter = itertools.count()
+        self.peak = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, time, event, entity):
+        """
+        Add an entity event to the queue.
+        """
+        key = (event, entity) # must be a unique key
+        if key in self._heap:
+            self.dropped += 1
+        # Counter prevents the comparison of entities,
+        # in case the time and the event are the same.
+        self._heap.push(key, (time, event, next(self._counter)))
+        self.peak = max(self.peak, len(self._heap))
+
+    def remove(self, event, entity):
+        """
+        Remove the entity event from the queue.
+        Return if the event was present.
+        """
+        key = (event, entity)
+        if key not in self._heap:
+            return False
+        self._heap.remove(key)
+        self.dropped += 1
+        return True
+
+    def pop(self):
+        """
+        Remove and return the next upcoming event.
+        Raise KeyError if the queue is empty.
+        """
+        if not self.empty():
+            (event, entity), (time, _, _) = self._heap.pop()
+            return time, event, entity
+        raise KeyError('pop from an empty priority queue')
+
+    def peek(self):
+        """
+        Peek at the next upcoming event.
+        Raise KeyError if the queue is empty.
+        """
+        if not self.empty():
+            (event, entity), (time, _, _) = self._heap.peek()
+            return time, event, entity
+        raise KeyError('peek from an empty priority queue')
+
+    def empty(self):
+        """
+        Check if the queue is empty.
+        """
+        return not self._heap
+
+
+class CalendarQueue(object):
+    """
+    A calendar queue with the same contract as the `PriorityQueue`,
+    for integer event times.
+
+    Events are hashed by time into buckets (days), each `_width` seconds
+    long, and the buckets repeat in cycles (years). The next event is
+    usually found in the bucket of the current day, which gives an
+    amortized O(1) cost for both adding and removing events.
+    The number of buckets and their width are recalculated when the
+    queue grows or shrinks.
+
+    (R. Brown, "Calendar queues: a fast O(1) priority queue
+    implementation for the simulation event set problem",
+    http://dx.doi.org/10.1145/63039.63045)
+    """
+
+    _MIN_SIZE = 16
+    _SAMPLE = 25
+
+    def __init__(self, width=60):
+        self._width = width
+        self._buckets = [[] for i in range(self._MIN_SIZE)]
         self._entries = {}
         self._counter = itertools.count()
+        # lower bound on the time of all events in the queue
+        self._last = 0
+        self.peak = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _bucket(self, time):
+        return self._buckets[(time // self._width) % len(self._buckets)]
+
+    def _insert(self, entry):
+        bisect.insort(self._bucket(entry[0]), entry)
+
+    def _delete(self, entry):
+        bucket = self._bucket(entry[0])
+        del bucket[bisect.bisect_left(bucket, entry)]
 
     def add(self, time, event, entity):
         """
         Add an entity event to the queue.
         """
+        assert isinstance(time, (int, long)), 'time must be an integer'
         key = (event, entity) # must be a unique key
         if key in self._entries:
-            # mark an existing event as removed
-            self._entries[key][-1] = self._REMOVED
+            self._delete(self._entries[key])
+            self.dropped += 1
         # Counter prevents the comparison of entities,
         # in case the time and the event are the same.
-        entry = [time, event, next(self._counter), entity]
+        entry = (time, event, next(self._counter), key)
         self._entries[key] = entry
-        heapq.heappush(self._pq, entry)
+        self._insert(entry)
+        self._last = min(self._last, time)
+        self.peak = max(self.peak, len(self._entries))
+        if len(self._entries) > 2 * len(self._buckets):
+            self._resize(2 * len(self._buckets))
+
+    def remove(self, event, entity):
+        """
+        Remove the entity event from the queue.
+        Return if the event was present.
+        """
+        entry = self._entries.pop((event, entity), None)
+        if entry is None:
+            return False
+        self._delete(entry)
+        self.dropped += 1
+        return True
 
     def pop(self):
         """
@@ -54,10 +182,13 @@ class PriorityQueue(object):
         Raise KeyError if the queue is empty.
         """
         if not self.empty():
-            time, event, _, entity = heapq.heappop(self._pq)
-            key = (event, entity)
+            bucket = self._find()
+            time, event, _, key = bucket.pop(0)
             del self._entries[key]
-            return time, event, entity
+            if (len(self._buckets) > self._MIN_SIZE and
+                len(self._entries) < len(self._buckets) / 2):
+                self._resize(len(self._buckets) / 2)
+            return time, event, key[1]
         raise KeyError('pop from an empty priority queue')
 
     def peek(self):
@@ -66,23 +197,136 @@ class PriorityQueue(object):
         Raise KeyError if the queue is empty.
         """
         if not self.empty():
-            time, event, _, entity = self._pq[0]
-            return time, event, entity
+            time, event, _, key = self._find()[0]
+            return time, event, key[1]
         raise KeyError('peek from an empty priority queue')
 
     def empty(self):
         """
         Check if the queue is empty.
         """
-        self._pop_removed()
-        return not self._pq
+        return not self._entries
+
+    def _find(self):
+        """
+        Return the bucket with the next upcoming event.
+        """
+        size = len(self._buckets)
+        day = self._last // self._width
+
+        for i in xrange(size):
+            bucket = self._buckets[(day + i) % size]
+            # the event must belong to this year
+            if bucket and bucket[0][0] < (day + i + 1) * self._width:
+                self._last = bucket[0][0]
+                return bucket
+        # Nothing in the whole year, the events are sparse.
+        # Jump directly to the earliest one.
+        bucket = min((b for b in self._buckets if b),
+                     key=lambda b: b[0])
+        self._last = bucket[0][0]
+        return bucket
+
+    def _resize(self, size):
+        """
+        Rebuild the calendar with a new number of buckets.
+        The bucket width is based on the average separation
+        of the upcoming events.
+        """
+        entries = self._entries.values()
+        sample = [e[0] for e in heapq.nsmallest(self._SAMPLE, entries)]
+        gaps = [b - a for a, b in zip(sample, sample[1:])]
+
+        if gaps and sum(gaps):
+            avg = float(sum(gaps)) / len(gaps)
+            # skip the unusually large separations
+            gaps = [g for g in gaps if g <= 2 * avg]
+            avg = float(sum(gaps)) / len(gaps)
+            self._width = max(int(3 * avg), 1)
+
+        self._buckets = [[] for i in range(size)]
+        for entry in entries:
+            self._bucket(entry[0]).append(entry)
+        for bucket in self._buckets:
+            bucket.sort()
+
+
+class VirtualClock(object):
+    """
+    A global clock of the virtual schedule.
+
+    The virtual schedule is a generalized processor sharing system,
+    each active user gets `shares / active_shares * max(cpu_used, 1)`
+    of the virtual time. The clock advances at the rate of
+    `max(cpu_used, 1) / active_shares`, so a user receives `shares`
+    times the clock change. Like in weighted fair queueing, this lets us
+    credit the users lazily and keep a virtual finish tag for the first
+    campaign of each active user. Only the users whose campaigns change
+    need to be touched.
+
+    Attributes:
+      time: the current virtual time.
+      next_end: the campaign with the queued `campaign_end` event.
+    """
+
+    def __init__(self):
+        self.time = 0.0
+        self.next_end = None
+        self._stamps = {}
+        self._tags = IndexedHeap()
+        self._dirty = set()
+
+    def advance(self, period, cpu_used, active_shares):
+        """
+        Move the clock forward by a real time `period`.
+        """
+        if not self._stamps:
+            self.time = 0.0  # nobody depends on the value
+        else:
+            self.time += period * float(max(cpu_used, 1)) / active_shares
+
+    def touch(self, user):
+        """
+        Credit the user with the virtual time received since the
+        last touch. Must be called after every change to the user
+        campaigns, including the (in)activity status.
+        """
+        stamp = self._stamps.pop(user, None)
+        if stamp is not None:
+            user.add_virtual((self.time - stamp) * user.shares)
+        if user.active_camps:
+            self._stamps[user] = self.time
+            self._dirty.add(user)
+        else:
+            self._dirty.discard(user)
+            if user in self._tags:
+                self._tags.remove(user)
+
+    def refresh(self):
+        """
+        Redistribute the virtual time of the touched users.
+        """
+        for user in self._dirty:
+            user.virtual_work()
+            self.retag(user)
+        self._dirty.clear()
+
+    def retag(self, user):
+        """
+        Update the finish tag of the user's first campaign.
+        """
+        first = user.active_camps[0]
+        tag = self._stamps[user] + float(first.time_left) / user.shares
+        self._tags.push(user, (tag, user.ID))
 
-    def _pop_removed(self):
+    def first(self):
         """
-        Process the queue to the first non-removed event.
+        Return the user whose first campaign ends the earliest
+        in the virtual schedule or `None`.
         """
-        while self._pq and self._pq[0][-1] == self._REMOVED:
-            heapq.heappop(self._pq)
+        if not self._tags:
+            return None
+        return self._tags.peek()[0]
 
 
 class Container(object):
@@ -92,6 +336,39 @@ class Container(object):
     pass
 
 
+class Partition(object):
+    """
+    The resources and the waiting jobs of a single partition.
+
+    Attributes:
+      name: partition number from the workload or `None`
+            if the whole system is simulated as one pool.
+      cpu_limit: number of CPUs.
+      cpu_used: number of CPUs used by the running jobs.
+      manager: cluster manager instance.
+      waiting_jobs: queue of the waiting jobs (see `waiting_queues`).
+      waiting_procs: `MinMultiset` of the waiting jobs CPU counts.
+      waiting_users: the number of waiting jobs of each user.
+      epoch: bumped on each change of the waiting jobs or the manager.
+      idle_backfill: the state of the last idle backfilling pass.
+    """
+
+    def __init__(self, name, cpus, manager, waiting_jobs):
+        self.name = name
+        self.cpu_limit = cpus
+        self.cpu_used = 0
+        self.manager = manager
+        self.waiting_jobs = waiting_jobs
+        self.waiting_procs = MinMultiset()
+        self.waiting_users = {}
+        self.epoch = 0
+        self.idle_backfill = None
+
+    @property
+    def cpu_free(self):
+        return self.cpu_limit - self.cpu_used
+
+
 class GeneralSimulator(object):
     """
     Defines the flow of the simulation.
@@ -105,7 +382,8 @@ class GeneralSimulator(object):
           block: a `Block` instance with the submitted `Jobs`.
           users: a dictionary of `Users`.
           settings: algorithmic settings
-          parts: *instances* of all the system parts
+          parts: *instances* of all the system parts,
+                 except the `manager` class
         """
         assert block and users, 'invalid arguments'
         self._block = block
@@ -114,9 +392,14 @@ class GeneralSimulator(object):
         self._users = users
         self._settings = settings
         self._parts = parts
-        # create an appropriate cluster manager
-        self._manager = cluster_managers.BaseManager(
-                            block.cpus, settings)
+        if block.partitions:
+            self._partition_cpus = block.partitions
+        else:
+            self._partition_cpus = {None: block.cpus}
+        assert sum(self._partition_cpus.itervalues()) == block.cpus, \
+            'invalid partition cpu count'
+        if settings.bf_batch and cluster_managers.numpy is None:
+            raise Exception('bf_batch requires numpy')
 
     def _initialize(self):
         """
@@ -127,23 +410,86 @@ class GeneralSimulator(object):
         self._stats.cpu_used = 0
         self._stats.active_shares = 0
         self._stats.total_usage = 0
+        self._stats.usage_scale = 1.0
         # diagnostic statistics
         self._diag = Container()
         self._diag.skipped = 0
         self._diag.forced = 0
         self._diag.sched_pass = self._diag.sched_jobs = 0
         self._diag.bf_pass = self._diag.bf_jobs = 0
+        self._diag.sched_skipped = self._diag.bf_skipped = 0
         self._diag.prev_util = {'time': None, 'value': 0}
         self._diag.avg_util = {'period': 0, 'sum': 0.0}
         self._diag.sim_time = time.time()
 
-        self._waiting_jobs = []
+        # each partition with its own cluster manager
+        self._partitions = {}
+        for name, cpus in self._partition_cpus.iteritems():
+            self._partitions[name] = Partition(
+                name,
+                cpus,
+                self._parts.manager(cpus, self._settings),
+                waiting_queues.get_queue(self._parts.scheduler,
+                                         self._settings),
+            )
+        self._part_list = [self._partitions[name]
+                           for name in sorted(self._partitions)]
+        self._init_capacity()
+        self._top_waiting = None
+        self._running_users = set()
         self._results = []
-        self._pq = PriorityQueue()
+        if self._settings.virtual_clock:
+            self._vclock = VirtualClock()
+        else:
+            self._vclock = None
+        if self._settings.event_queue == 'heap':
+            self._pq = PriorityQueue()
+        elif self._settings.event_queue == 'calendar':
+            self._pq = CalendarQueue()
+        else:
+            raise Exception('unknown event queue %s'
+                            % self._settings.event_queue)
         self._compressor = zlib.compressobj()
         # link the scheduler to the simulation
         self._parts.scheduler.set_stats(self._stats)
 
+    def _init_capacity(self):
+        """
+        Give the capacity timeline to the partition managers.
+        The changes up to the first submission are applied now,
+        the later ones with the capacity events.
+        """
+        self._cap_changes = []
+        self._cap_queued = False
+        if not self._block.capacity:
+            return
+        timeline = {}
+        for name, changes in self._block.capacity.iteritems():
+            if len(self._part_list) == 1:
+                part = self._part_list[0]
+            elif name is None:
+                raise Exception('capacity change without a partition')
+            elif name in self._partitions:
+                part = self._partitions[name]
+            else:
+                continue  # no jobs in this partition
+            merged = timeline.setdefault(part, {})
+            for time, change in changes:
+                merged[time] = merged.get(time, 0) + change
+
+        start = self._block[0].submit
+        for part, merged in timeline.iteritems():
+            changes = sorted(merged.iteritems())
+            part.manager.set_capacity(changes)
+            for time, change in changes:
+                if time <= start:
+                    part.cpu_limit += change
+                    self._cpu_limit += change
+                else:
+                    self._cap_changes.append((time, part.name, change))
+        # consumed from the end
+        self._cap_changes.sort(reverse=True)
+
     def _finalize(self):
         """
         Final step after the simulation has ended.
@@ -155,6 +501,8 @@ class GeneralSimulator(object):
         self._diag.sim_time = time.time() - self._diag.sim_time
         self._diag.sched_jobs /= float(len(self._block))
         self._diag.bf_jobs /= float(len(self._block))
+        self._diag.queue_peak = self._pq.peak
+        self._diag.queue_dropped = self._pq.dropped
         # clear the link to the scheduler
         self._parts.scheduler.clear_stats()
 
@@ -167,14 +515,15 @@ class GeneralSimulator(object):
         logging.info(msg.format(self._block.number, self._parts.scheduler,
                      time.strftime('%H:%M:%S'), completed * 100))
 
-        top_proc = self._waiting_jobs and self._waiting_jobs[-1].proc
+        top_proc = self._top_waiting and self._top_waiting.proc
         util = (self._diag.avg_util['period'] and
                (self._diag.avg_util['sum'] / self._diag.avg_util['period']))
 
         logging.info('cpus {} {} | waiting jobs {} {} | util {:.2f}'
                      ' | scheduling {:.2f} {:.2f}'.format(
                      self._stats.cpu_used, self._cpu_free,
-                     len(self._waiting_jobs), top_proc,
+                     sum(len(p.waiting_jobs) for p in self._part_list),
+                     top_proc,
                      util,
                      self._diag.sched_jobs / float(submitted),
                      self._diag.bf_jobs / float(submitted)
@@ -188,12 +537,18 @@ class GeneralSimulator(object):
 
         # Magic value taken from slurm/multifactor plugin.
         self._decay_factor = 1 - (0.693 / self._settings.decay)
+        # the same decay in a continuous form
+        self._decay_rate = -math.log(self._decay_factor)
         # Note:
         #   The CPU usage decay is always applied after each event.
         #   There is also a dummy `force_decay` event inserted into
         #   the queue to force the calculations in case the gap
         #   between consecutive events would be too long.
+        #   With `exact_decay` the usage is integrated exactly
+        #   and the dummy event is not needed.
         self._force_period = 60 * 5
+        # start a new decay epoch below this scale
+        self._min_usage_scale = 1e-100
 
         self._initialize()
 
@@ -201,7 +556,10 @@ class GeneralSimulator(object):
         sub_total = len(self._block)
         end_iter = 0
 
-        schedule = backfill = False
+        # the partitions to schedule and backfill
+        schedule = set()
+        backfill = set()
+        full_sched = False
         instant_bf = (self._settings.bf_depth and
                       not self._settings.bf_interval)
 
@@ -243,9 +601,10 @@ class GeneralSimulator(object):
 
             if event == Events.new_job:
                 # check if the job is runnable
-                if self._manager.runnable(entity):
+                part = self._partition(entity)
+                if part.manager.runnable(entity):
                     self._new_job_event(entity)
-                    schedule = True
+                    schedule.add(part)
                 else:
                     self._diag.skipped += 1
                     end_iter += 1
@@ -253,14 +612,25 @@ class GeneralSimulator(object):
             elif event == Events.job_end:
                 self._job_end_event(entity)
                 end_iter += 1
-                schedule = True
+                schedule.add(self._partition(entity))
             elif event == Events.estimate_end:
                 self._estimate_end_event(entity)
+            elif event == Events.sched_run:
+                schedule.update(self._part_list)
+                full_sched = True
+            elif event == Events.capacity_change:
+                changed = self._capacity_event()
+                schedule.update(changed)
+                full_sched = True
+                if self._settings.bf_depth:
+                    backfill.update(changed)
             elif event == Events.bf_run:
-                backfill = True
+                backfill.update(self._part_list)
             elif event == Events.campaign_end:
                 # We need to redistribute the virtual time now,
                 # so the campaign can actually end.
+                if self._vclock is not None:
+                    self._vclock.touch(entity.user)
                 self._virt_second_stage()
                 virt_second = False  # already done
                 campaigns = self._camp_end_event(entity)
@@ -287,25 +657,51 @@ class GeneralSimulator(object):
                 self._virt_second_stage()
 
             if schedule:
-                scheduled_jobs = self._schedule(bf_mode=False)
-                self._diag.sched_jobs += scheduled_jobs
-                self._diag.sched_pass += 1
+                if full_sched:
+                    depth = None
+                else:
+                    depth = self._settings.default_queue_depth
+                # only the partitions affected by the events
+                for part in self._part_list:
+                    if part not in schedule:
+                        continue
+                    if self._futile_pass(part):
+                        self._diag.sched_skipped += 1
+                        continue
+                    scheduled_jobs = self._schedule(part, bf_mode=False,
+                                                    depth=depth)
+                    self._diag.sched_jobs += scheduled_jobs
+                    self._diag.sched_pass += 1
                 self._update_util()  # must be after schedule
-                schedule = False
-                if instant_bf: backfill = True
+                if instant_bf: backfill.update(schedule)
+                schedule.clear()
+                full_sched = False
 
             if backfill:
-                backfilled_jobs = self._schedule(bf_mode=True)
-                self._diag.bf_jobs += backfilled_jobs
-                self._diag.bf_pass += 1
+                backfilled_jobs = 0
+                for part in self._part_list:
+                    if part not in backfill:
+                        continue
+                    if self._futile_pass(part):
+                        self._diag.bf_skipped += 1
+                        continue
+                    unchanged, jobs = self._unchanged_backfill(part)
+                    if unchanged:
+                        self._diag.bf_skipped += 1
+                        continue
+                    bf_jobs = self._schedule(part, bf_mode=True, jobs=jobs)
+                    backfilled_jobs += bf_jobs
+                    self._diag.bf_jobs += bf_jobs
+                    self._diag.bf_pass += 1
                 self._update_util()  # must be after schedule
-                backfill = False
+                backfill.clear()
 
             if campaigns:
                 self._update_camp_estimates()
 
             # add periodically occurring events
-            if event < Events.bf_run:
+            if event < Events.sched_run:
+                self._next_sched(self._now)
                 self._next_backfill(self._now)
             elif event == Events.bf_run and backfilled_jobs:
                 self._next_backfill(self._now + 1)
@@ -313,6 +709,7 @@ class GeneralSimulator(object):
             if end_iter < sub_total:
                 # There are still jobs in the simulation
                 # so we need an accurate usage.
+                self._next_capacity()
                 assert not self._pq.empty(), 'infinite loop'
                 self._next_force_decay()
 
@@ -341,7 +738,13 @@ class GeneralSimulator(object):
         """
         In the first virtual stage we just distribute
         the virtual time for the period to active users.
+
+        With the `_vclock` only the global virtual time advances.
         """
+        if self._vclock is not None:
+            self._vclock.advance(period, self._stats.cpu_used,
+                                 self._stats.active_shares)
+            return
         for u in self._users.itervalues():
             if u.active_camps:
                 u.add_virtual(period * self._share_cpu_value(u))
@@ -350,7 +753,12 @@ class GeneralSimulator(object):
         """
         In the second virtual stage active users redistribute
         the accumulated virtual time.
+
+        With the `_vclock` only the touched users do it.
         """
+        if self._vclock is not None:
+            self._vclock.refresh()
+            return
         for u in self._users.itervalues():
             if u.active_camps:
                 u.virtual_work()
@@ -360,17 +768,45 @@ class GeneralSimulator(object):
         Update the real work done by the jobs in the period
         and apply the rolling decay.
 
+        The usages are stored in the decay epoch coordinates,
+        the decayed values are the stored ones multiplied by
+        `_stats.usage_scale`. This way the decay is applied only
+        to the global scale and the work is added only for the
+        users that have running jobs.
+
         This is currently the only real stage.
         """
         # calculate the decay factor for the period
         real_decay = self._decay_factor ** period
+        # the period in the decay epoch coordinates
+        if self._settings.exact_decay:
+            # The work done at a constant CPU count under
+            # a continuous decay, integrated over the period:
+            #   (1 - real_decay) / decay_rate
+            # after the decay is applied.
+            work = ((1 / real_decay - 1) / self._decay_rate /
+                    self._stats.usage_scale)
+        else:
+            work = period / self._stats.usage_scale
         # update global statistics
-        self._stats.total_usage += self._stats.cpu_used * period
-        self._stats.total_usage *= real_decay
+        self._stats.total_usage += self._stats.cpu_used * work
         # and update users usage
+        for u in self._running_users:
+            u.real_work(work)
+        # apply the decay
+        self._stats.usage_scale *= real_decay
+        if self._stats.usage_scale < self._min_usage_scale:
+            self._renormalize_usage()
+
+    def _renormalize_usage(self):
+        """
+        Start a new decay epoch before the stored usages get too big.
+        """
+        scale = self._stats.usage_scale
         for u in self._users.itervalues():
-            u.real_work(period)
-            u.cpu_clock_used *= real_decay
+            u.cpu_clock_used *= scale
+        self._stats.total_usage *= scale
+        self._stats.usage_scale = 1.0
 
     def _share_cpu_value(self, user):
         """
@@ -400,11 +836,41 @@ class GeneralSimulator(object):
         Update estimated campaign end times in the virtual schedule.
         Only the first campaign is considered from each user,
         since the subsequent campaigns are guaranteed to end later.
-        """
+
+        With the `_vclock` only the campaign with the earliest finish
+        tag has a `campaign_end` event.
+        """
+        if self._vclock is not None:
+            user = self._vclock.first()
+            camp = user and user.active_camps[0]
+            prev = self._vclock.next_end
+            if prev is not None and prev != camp:
+                self._pq.remove(Events.campaign_end, prev)
+            if camp is not None:
+                # bring the campaign up to date
+                self._vclock.touch(user)
+                self._vclock.refresh()
+                self._queue_camp_end(camp)
+            self._vclock.next_end = camp
+            return
         for u in self._users.itervalues():
             if u.active_camps:
                 self._queue_camp_end(u.active_camps[0])
 
+    def _next_sched(self, start):
+        """
+        Add the next full scheduling event after `start`.
+        """
+        if not self._settings.sched_interval:
+            return  # only the event triggered passes
+        next_sched = float(start) / self._settings.sched_interval
+        next_sched = math.ceil(next_sched) * self._settings.sched_interval
+        self._pq.add(
+            int(next_sched),  # must be int
+            Events.sched_run,
+            'Schedule event'
+        )
+
     def _next_backfill(self, start):
         """
         Add the next backfill event after `start`.
@@ -420,10 +886,44 @@ class GeneralSimulator(object):
             'Backfill event'
         )
 
+    def _next_capacity(self):
+        """
+        Add the next capacity change event.
+        """
+        if self._cap_queued or not self._cap_changes:
+            return
+        self._pq.add(
+            self._cap_changes[-1][0],
+            Events.capacity_change,
+            'Capacity event'
+        )
+        self._cap_queued = True
+
+    def _capacity_event(self):
+        """
+        Update the CPU limits with the capacity changes made now.
+        The managers already have them in the profile.
+
+        Return the changed partitions.
+        """
+        self._cap_queued = False
+        changed = set()
+        while self._cap_changes and self._cap_changes[-1][0] == self._now:
+            _, name, change = self._cap_changes.pop()
+            part = self._partitions[name]
+            part.cpu_limit += change
+            self._cpu_limit += change
+            # the free resources changed without a job event
+            part.epoch += 1
+            changed.add(part)
+        return changed
+
     def _next_force_decay(self):
         """
         Add/update the next decay event.
         """
+        if self._settings.exact_decay:
+            return  # the usage is always accurate
         self._pq.add(
             self._now + self._force_period,
             Events.force_decay,
@@ -433,8 +933,10 @@ class GeneralSimulator(object):
     @property
     def _utility(self):
         """
-        Cluster usage.
+        Cluster usage of the current capacity.
         """
+        if not self._cpu_limit:
+            return 0.0  # the whole cluster is down
         return float(self._stats.cpu_used) / self._cpu_limit
 
     @property
@@ -444,14 +946,26 @@ class GeneralSimulator(object):
         """
         return self._cpu_limit - self._stats.cpu_used
 
+    def _partition(self, job):
+        """
+        Return the `Partition` of the job.
+        """
+        if len(self._part_list) == 1:
+            return self._part_list[0]
+        return self._partitions[job.partition]
+
     def _execute(self, job):
         """
         Start the job execution.
         """
         job.start_execution(self._now)
+        part = self._partition(job)
+        part.epoch += 1
         # update stats
+        part.cpu_used += job.proc
         self._stats.cpu_used += job.proc
-        assert self._cpu_free >= 0, 'invalid cpu count'
+        self._running_users.add(job.user)
+        assert part.cpu_free >= 0, 'invalid cpu count'
         # add events
         self._pq.add(
             self._now + job.run_time,
@@ -465,56 +979,132 @@ class GeneralSimulator(object):
                 job
             )
 
-    def _schedule(self, bf_mode):
+    def _futile_pass(self, part):
+        """
+        Check if a scheduling pass cannot start any job,
+        because all the waiting jobs need more CPUs than are free.
+        """
+        min_proc = part.waiting_procs.min()
+        return min_proc is None or min_proc > part.cpu_free
+
+    def _unchanged_backfill(self, part):
         """
-        Try to execute the highest priority jobs.
+        Check if the last backfilling pass started nothing and
+        the state it depended on is still the same.
+
+        The space list is fixed in absolute time between the
+        epoch changes, so only the backfilling window and
+        the job priorities can differ.
 
-        If not in `bf_mode` stop on the first failure.
+        Return the result and the waiting jobs in the priority
+        order for the pass, or `None` if they were not needed.
+        """
+        if part.idle_backfill is None:
+            return False, None
+        epoch, tried = part.idle_backfill
+        if epoch != part.epoch:
+            return False, None
+        if tried is None:
+            return True, None  # static priorities
+        self._sync_priorities(part)
+        jobs = part.waiting_jobs.ordered()
+        prefix = tuple(itertools.islice(jobs, len(tried)))
+        if prefix == tried:
+            return True, None
+        return False, itertools.chain(prefix, jobs)
+
+    def _sync_priorities(self, part):
+        """
+        Bring the campaigns of the partition waiting jobs up to date.
+        """
+        if (self._vclock is not None and
+            not self._parts.scheduler.only_real):
+            for u in part.waiting_users:
+                self._vclock.touch(u)
+            self._vclock.refresh()
+
+    def _schedule(self, part, bf_mode, depth=None, jobs=None):
+        """
+        Try to execute the highest priority jobs from the partition.
+
+        If not in `bf_mode` stop on the first failure
+        or after testing `depth` jobs (if set).
+        The `jobs` already in the priority order are used if given.
 
         Return the number of started jobs.
         """
 
-        if not self._cpu_free or not self._waiting_jobs:
+        if not part.cpu_free or not part.waiting_jobs:
             return 0  # nothing to do
 
-        #sort the jobs using the ordering defined by the scheduler
-        self._waiting_jobs.sort(
-            key=self._parts.scheduler.job_priority_key,
-            reverse=True
-        )
+        if jobs is None:
+            # the campaigns must be up to date for the scheduler
+            self._sync_priorities(part)
+            jobs = part.waiting_jobs.ordered()
+        manager = part.manager
 
         if bf_mode:
-            try_func = self._manager.try_backfill
+            try_func = manager.try_backfill
             assert self._settings.bf_depth, 'invalid bf_depth'
-            work = min(len(self._waiting_jobs), self._settings.bf_depth)
+            work = min(len(part.waiting_jobs), self._settings.bf_depth)
         else:
-            try_func = self._manager.try_schedule
-            work = len(self._waiting_jobs)
-
-        self._manager.start_session(self._now)
-
-        # last job has the highest priority
-        prio_iter = len(self._waiting_jobs) - 1
-        started = 0
-
-        while self._cpu_free and work:
-            job = self._waiting_jobs[prio_iter]
+            try_func = manager.try_schedule
+            work = len(part.waiting_jobs)
+            if depth:
+                work = min(work, depth)
+
+        manager.start_session(self._now)
+
+        if bf_mode and self._settings.bf_batch:
+            # plan the whole pass at once, the loop below
+            # stops at the same job as the planner
+            jobs = list(itertools.islice(jobs, work))
+            results = iter(manager.try_backfill_batch(jobs))
+            try_func = lambda job: next(results)
+
+        started = []
+        tried = []
+        self._top_waiting = None
+
+        # iterate using the ordering defined by the scheduler
+        for job in jobs:
+            if not part.cpu_free or not work:
+                break
 
+            tried.append(job)
             if try_func(job):
-                j2 = self._waiting_jobs.pop(prio_iter)
-                assert job == j2, 'scheduled wrong job'
-
+                started.append(job)
                 self._execute(job)
-                started += 1
                 logging.debug('bf %s started %s', bf_mode, job)
-            elif not bf_mode:
-                break
+            else:
+                if self._top_waiting is None:
+                    self._top_waiting = job
+                if not bf_mode:
+                    break
 
-            prio_iter -= 1
             work -= 1
 
-        self._manager.end_session()
-        return started
+        manager.end_session()
+        # the queue can be modified only after the iteration
+        for job in started:
+            part.waiting_jobs.remove(job)
+            part.waiting_procs.remove(job.proc)
+            count = part.waiting_users[job.user] - 1
+            if count:
+                part.waiting_users[job.user] = count
+            else:
+                del part.waiting_users[job.user]
+
+        if bf_mode:
+            # Remember an idle pass, unless its result
+            # depended on the current backfilling window.
+            if started or manager.window_reached:
+                part.idle_backfill = None
+            elif self._parts.scheduler.static_priority:
+                part.idle_backfill = (part.epoch, None)
+            else:
+                part.idle_backfill = (part.epoch, tuple(tried))
+        return len(started)
 
     def _new_job_event(self, job):
         """
@@ -535,8 +1125,14 @@ class GeneralSimulator(object):
 
         camp.add_job(job)
         user.add_job(job)
+        if self._vclock is not None:
+            self._vclock.touch(user)
         # enqueue the job
-        self._waiting_jobs.append(job)
+        part = self._partition(job)
+        part.waiting_jobs.add(job)
+        part.waiting_procs.add(job.proc)
+        part.waiting_users[user] = part.waiting_users.get(user, 0) + 1
+        part.epoch += 1
 
     def _job_end_event(self, job):
         """
@@ -544,9 +1140,16 @@ class GeneralSimulator(object):
         """
         assert job.estimate >= job.run_time, 'invalid estimate'
         job.execution_ended(self._now)
-        self._manager.job_ended(job)
+        if self._vclock is not None:
+            self._vclock.touch(job.user)
+        part = self._partition(job)
+        part.manager.job_ended(job)
+        part.epoch += 1
+        part.cpu_used -= job.proc
         self._stats.cpu_used -= job.proc
         assert self._stats.cpu_used >= 0, 'invalid cpu count'
+        if not job.user.occupied_cpus:
+            self._running_users.remove(job.user)
         self._store_job_ended(job)  # add results
 
     def _estimate_end_event(self, job):
@@ -563,6 +1166,8 @@ class GeneralSimulator(object):
 
         new_est = self._parts.estimator.next_estimate(job)
         job.next_estimate(new_est)
+        if self._vclock is not None:
+            self._vclock.touch(user)
 
         # add the next event if we will need it
         if job.estimate < job.run_time:
@@ -581,12 +1186,17 @@ class GeneralSimulator(object):
         """
         user = camp.user
 
+        if self._vclock is not None:
+            # the only queued `campaign_end` event was just consumed,
+            # so we always need to queue the next one
+            self._vclock.next_end = None
+
         if not user.active_camps or camp != user.active_camps[0]:
-            # In the `_update_camp_estimates` we aren't removing
-            # the old `campaign_end` events from the queue,
-            # so it is possible that this event is out of order.
+            # A campaign can lose its first place, when an earlier
+            # one is made active again by `job_next_estimate`.
+            # Its `campaign_end` event is then out of order.
             logging.debug('Skipping campaign_end event %s', camp)
-            return
+            return self._vclock is not None
 
         while user.active_camps and not user.active_camps[0].time_left:
             # remove in one go all of the campaigns that end now
@@ -599,8 +1209,13 @@ class GeneralSimulator(object):
             self._stats.active_shares -= user.shares
             # fix possible rounding errors
             self._stats.active_shares = max(self._stats.active_shares, 0)
+            if self._vclock is not None:
+                self._vclock.touch(user)
             # we need new estimates, because the shares changed
             return True
+        elif self._vclock is not None:
+            self._vclock.retag(user)
+            return True
         else:
             self._queue_camp_end(user.active_camps[0])
             # shares are still the same
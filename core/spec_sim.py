@@ -25,6 +25,10 @@ class RealSimulator(GeneralSimulator):
     Only keeps track of the real CPU usage.
     """
 
+    def _initialize(self):
+        GeneralSimulator._initialize(self)
+        self._vclock = None  # virtual campaigns are not tracked
+
     def _virt_first_stage(self, period):
         pass
 
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 """
-Usefull functions.
+Usefull functions and helper classes.
 """
+import heapq
+
 
 def delta(seconds):
     """
@@ -13,3 +15,183 @@ def delta(seconds):
     m, s = divmod(seconds, 60)
     h, m = divmod(m, 60)
     return '{}:{:02}:{:02}'.format(h, m, s)
+
+
+class IndexedHeap(object):
+    """
+    A binary min-heap with a position index.
+
+    Each entry is stored under an unique (hashable) handle, so it
+    can be found, re-keyed or removed in logarithmic time.
+    The entries themselves are compared as a whole.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._handles = []
+        self._pos = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, handle):
+        return handle in self._pos
+
+    def __iter__(self):
+        """
+        Iterate over the handles in an arbitrary order.
+        """
+        return iter(self._handles)
+
+    def get(self, handle):
+        """
+        Return the entry stored under the `handle`.
+        """
+        return self._heap[self._pos[handle]]
+
+    def push(self, handle, entry):
+        """
+        Add the entry. An entry already stored under
+        the same `handle` is replaced.
+        """
+        if handle in self._pos:
+            i = self._pos[handle]
+            old = self._heap[i]
+            self._heap[i] = entry
+            if entry < old:
+                self._sift_up(i)
+            else:
+                self._sift_down(i)
+        else:
+            self._heap.append(entry)
+            self._handles.append(handle)
+            self._sift_up(len(self._heap) - 1)
+
+    def remove(self, handle):
+        """
+        Remove and return the entry stored under the `handle`.
+        Raise KeyError if there is no such entry.
+        """
+        i = self._pos.pop(handle)
+        entry = self._heap[i]
+        last_entry = self._heap.pop()
+        last_handle = self._handles.pop()
+        if i < len(self._heap):
+            # fill the gap with the last leaf
+            self._heap[i] = last_entry
+            self._handles[i] = last_handle
+            if last_entry < entry:
+                self._sift_up(i)
+            else:
+                self._sift_down(i)
+        return entry
+
+    def peek(self):
+        """
+        Return the smallest <handle, entry> pair.
+        Raise KeyError if the heap is empty.
+        """
+        if not self._heap:
+            raise KeyError('peek from an empty heap')
+        return self._handles[0], self._heap[0]
+
+    def pop(self):
+        """
+        Remove and return the smallest <handle, entry> pair.
+        Raise KeyError if the heap is empty.
+        """
+        handle, _ = self.peek()
+        return handle, self.remove(handle)
+
+    def ordered(self):
+        """
+        Iterate over the <handle, entry> pairs from the smallest entry,
+        without removing them. Getting the first `k` pairs takes
+        O(k log k) time.
+
+        Note:
+          The heap **MUST NOT** be modified during the iteration.
+        """
+        heap = self._heap
+        if not heap:
+            return
+        front = [(heap[0], 0)]
+        while front:
+            entry, i = heapq.heappop(front)
+            yield self._handles[i], entry
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(front, (heap[child], child))
+
+    def _sift_up(self, i):
+        heap, handles, pos = self._heap, self._handles, self._pos
+        entry, handle = heap[i], handles[i]
+        while i > 0:
+            parent = (i - 1) >> 1
+            if not entry < heap[parent]:
+                break
+            heap[i] = heap[parent]
+            handles[i] = handles[parent]
+            pos[handles[i]] = i
+            i = parent
+        heap[i] = entry
+        handles[i] = handle
+        pos[handle] = i
+
+    def _sift_down(self, i):
+        heap, handles, pos = self._heap, self._handles, self._pos
+        entry, handle = heap[i], handles[i]
+        size = len(heap)
+        while True:
+            child = 2 * i + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1] < heap[child]:
+                child += 1
+            if not heap[child] < entry:
+                break
+            heap[i] = heap[child]
+            handles[i] = handles[child]
+            pos[handles[i]] = i
+            i = child
+        heap[i] = entry
+        handles[i] = handle
+        pos[handle] = i
+
+
+class MinMultiset(object):
+    """
+    A multiset of values with a constant time minimum lookup.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._values = IndexedHeap()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value):
+        count = self._counts.get(value, 0)
+        if not count:
+            self._values.push(value, value)
+        self._counts[value] = count + 1
+        self._size += 1
+
+    def remove(self, value):
+        count = self._counts[value] - 1
+        if not count:
+            del self._counts[value]
+            self._values.remove(value)
+        else:
+            self._counts[value] = count
+        self._size -= 1
+
+    def min(self):
+        """
+        Return the smallest value or None if empty.
+        """
+        if not self._size:
+            return None
+        return self._values.peek()[0]
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+import heapq
+from abc import ABCMeta, abstractmethod
+from array import array
+from operator import attrgetter, itemgetter
+from util import IndexedHeap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Queues of the jobs waiting for execution.
+
+Each queue yields the jobs in the priority order defined by the scheduler,
+using the fastest method supported by the scheduler (see `get_queue`).
+"""
+
+
+def get_queue(scheduler, settings):
+    """
+    Return a waiting queue for the scheduler based on the settings.
+    """
+    if settings.waiting_queue == 'list':
+        return ListQueue(scheduler)
+    elif settings.waiting_queue == 'array':
+        if numpy is None:
+            raise Exception('the array queue requires numpy')
+        if not has_batch_priority(scheduler):
+            raise Exception('%s has no batch_priority' % scheduler)
+        return ArrayQueue(scheduler)
+    elif settings.waiting_queue != 'auto':
+        raise Exception('unknown waiting queue %s' % settings.waiting_queue)
+
+    if scheduler.static_priority:
+        return StaticQueue(scheduler)
+    if scheduler.priority_group is not None:
+        return GroupQueue(scheduler)
+    if numpy is not None and has_batch_priority(scheduler):
+        return ArrayQueue(scheduler)
+    return ListQueue(scheduler)
+
+
+def has_batch_priority(scheduler):
+    """
+    Check if the scheduler overrides the `batch_priority` method.
+    """
+    for cls in type(scheduler).__mro__:
+        if 'batch_priority' in cls.__dict__:
+            return cls.__name__ != 'BaseScheduler'
+    return False
+
+
+class BaseQueue(object):
+    """
+    Waiting queues base class. Subclasses are required to override:
+
+    1) add
+    2) remove
+    3) ordered
+    4) __iter__
+    5) __len__
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+
+    @abstractmethod
+    def add(self, job):
+        """
+        Add a newly submitted job.
+        """
+        raise NotImplemented
+
+    @abstractmethod
+    def remove(self, job):
+        """
+        Remove a job that started the execution.
+        """
+        raise NotImplemented
+
+    @abstractmethod
+    def ordered(self):
+        """
+        Iterate over the jobs from the highest priority.
+        The priority is evaluated when the iteration starts.
+
+        Note:
+          The queue **MUST NOT** be modified during the iteration.
+        """
+        raise NotImplemented
+
+    @abstractmethod
+    def __iter__(self):
+        """
+        Iterate over the jobs in an arbitrary order.
+        """
+        raise NotImplemented
+
+    @abstractmethod
+    def __len__(self):
+        raise NotImplemented
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class ListQueue(BaseQueue):
+    """
+    A list of jobs, keyed by the `job_priority_key` before
+    each iteration. Works with any scheduler.
+
+    The keyed jobs are only heapified and popped lazily,
+    so the cost of the iteration beyond the key evaluation
+    depends on the number of jobs actually examined.
+    """
+
+    def __init__(self, *args):
+        BaseQueue.__init__(self, *args)
+        self._jobs = []
+        self._pos = {}
+
+    def add(self, job):
+        self._pos[job] = len(self._jobs)
+        self._jobs.append(job)
+
+    def remove(self, job):
+        # move the last job to the freed position
+        i = self._pos.pop(job)
+        last = self._jobs.pop()
+        if last is not job:
+            self._jobs[i] = last
+            self._pos[last] = i
+
+    def ordered(self):
+        key = self._scheduler.job_priority_key
+        # the position breaks the ties, the jobs are never compared
+        heap = [(key(job), i, job) for i, job in enumerate(self._jobs)]
+        heapq.heapify(heap)
+        while heap:
+            yield heapq.heappop(heap)[2]
+
+    def __iter__(self):
+        return iter(self._jobs)
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+class StaticQueue(BaseQueue):
+    """
+    A heap of jobs ordered by the `job_priority_key`,
+    for schedulers with `static_priority`.
+    """
+
+    def __init__(self, *args):
+        BaseQueue.__init__(self, *args)
+        self._jobs = IndexedHeap()
+
+    def add(self, job):
+        self._jobs.push(job, self._scheduler.job_priority_key(job))
+
+    def remove(self, job):
+        self._jobs.remove(job)
+
+    def ordered(self):
+        return (job for job, _ in self._jobs.ordered())
+
+    def __iter__(self):
+        return iter(self._jobs)
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+class GroupQueue(BaseQueue):
+    """
+    A two-level queue for schedulers with group-level priorities
+    (see `BaseScheduler.priority_group`).
+
+    Each group keeps its jobs in a heap ordered by the static
+    `group_job_key`. Before each iteration only the groups are
+    sorted by the `group_priority_key`, starting from the order
+    of the last iteration, so the sort is nearly linear when few
+    keys change. The jobs of each group are then chained, only
+    the groups with equal keys are merged by the job keys.
+    """
+
+    _owners = {
+        'campaign': attrgetter('camp'),
+        'user': attrgetter('user'),
+    }
+
+    def __init__(self, *args):
+        BaseQueue.__init__(self, *args)
+        group = self._scheduler.priority_group
+        if group not in self._owners:
+            raise Exception('unknown priority group %s' % group)
+        self._owner = self._owners[group]
+        self._groups = {}
+        # the groups in the order of the last iteration
+        self._order = []
+        # the groups that lost their last job
+        self._emptied = set()
+        self._count = 0
+
+    def add(self, job):
+        group = self._owner(job)
+        jobs = self._groups.get(group)
+        if jobs is None:
+            jobs = self._groups[group] = IndexedHeap()
+            self._order.append(group)
+        jobs.push(job, self._scheduler.group_job_key(job))
+        self._count += 1
+
+    def remove(self, job):
+        group = self._owner(job)
+        jobs = self._groups[group]
+        jobs.remove(job)
+        if not jobs:
+            self._emptied.add(group)
+        self._count -= 1
+
+    def ordered(self):
+        groups = self._groups
+        if self._emptied:
+            for group in self._emptied:
+                if not groups[group]:
+                    del groups[group]
+            self._emptied.clear()
+            self._order = [g for g in self._order if g in groups]
+
+        keys = map(self._scheduler.group_priority_key, self._order)
+        keyed = zip(keys, self._order)
+        keyed.sort(key=itemgetter(0))  # the groups are never compared
+        self._order = map(itemgetter(1), keyed)
+
+        i = 0
+        while i < len(keyed):
+            group_key, group = keyed[i]
+            i += 1
+            if i == len(keyed) or keyed[i][0] != group_key:
+                for job, _ in groups[group].ordered():
+                    yield job
+                continue
+            # merge the jobs of the groups with equal keys
+            tied = [groups[group]]
+            while i < len(keyed) and keyed[i][0] == group_key:
+                tied.append(groups[keyed[i][1]])
+                i += 1
+            merged = heapq.merge(*[self._tagged(jobs, tag)
+                                   for tag, jobs in enumerate(tied)])
+            for _, _, job in merged:
+                yield job
+
+    @staticmethod
+    def _tagged(jobs, tag):
+        # the tag prevents the comparison of the jobs
+        for job, job_key in jobs.ordered():
+            yield job_key, tag, job
+
+    def __iter__(self):
+        for jobs in self._groups.itervalues():
+            for job in jobs:
+                yield job
+
+    def __len__(self):
+        return self._count
+
+
+class _Slots(object):
+    """
+    Assign reusable array indexes to the users or campaigns
+    with waiting jobs.
+    """
+
+    def __init__(self):
+        self.owners = []
+        self._index = {}
+        self._refs = []
+        self._free = []
+
+    def acquire(self, owner):
+        if owner in self._index:
+            i = self._index[owner]
+        elif self._free:
+            i = self._free.pop()
+            self._index[owner] = i
+            self.owners[i] = owner
+        else:
+            i = len(self.owners)
+            self._index[owner] = i
+            self.owners.append(owner)
+            self._refs.append(0)
+        self._refs[i] += 1
+        return i
+
+    def release(self, owner):
+        i = self._index[owner]
+        self._refs[i] -= 1
+        if not self._refs[i]:
+            del self._index[owner]
+            self.owners[i] = None
+            self._free.append(i)
+
+
+class BatchView(object):
+    """
+    Column arrays of the waiting jobs passed to the
+    `BaseScheduler.batch_priority` method.
+
+    Job columns (one value for each job):
+      ID, submit, estimate, proc, user (index to the user columns),
+      camp (index to the campaign columns), time_left, created.
+
+    User columns:
+      shares, cpu_clock_used, user_id.
+
+    Campaign columns:
+      camp_time_left, camp_created, camp_id.
+
+    The user and campaign columns can contain meaningless values
+    at the indexes not referenced by any job.
+    All the columns are evaluated on the first access.
+    """
+
+    def __init__(self, queue):
+        self._queue = queue
+        self._cache = {}
+
+    def _job_column(self, name):
+        return numpy.frombuffer(self._queue._cols[name], dtype=numpy.int_)
+
+    def _owner_column(self, slots, func, dtype, unused=0):
+        return numpy.fromiter((func(o) if o is not None else unused
+                               for o in slots.owners),
+                              dtype=dtype, count=len(slots.owners))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._cache:
+            self._cache[name] = self._evaluate(name)
+        return self._cache[name]
+
+    def _evaluate(self, name):
+        users = self._queue._users
+        camps = self._queue._camps
+        if name in self._queue._cols:
+            return self._job_column(name)
+        elif name == 'shares':
+            return self._owner_column(users, lambda u: u.shares,
+                                      numpy.float64, unused=1)
+        elif name == 'cpu_clock_used':
+            return self._owner_column(users, lambda u: u.cpu_clock_used,
+                                      numpy.float64)
+        elif name == 'user_id':
+            return self._owner_column(users, lambda u: u.ID, numpy.int_)
+        elif name == 'camp_time_left':
+            return self._owner_column(camps, lambda c: c.time_left,
+                                      numpy.int_)
+        elif name == 'camp_created':
+            return self._owner_column(camps, lambda c: c.created,
+                                      numpy.int_)
+        elif name == 'camp_id':
+            return self._owner_column(camps, lambda c: c.ID, numpy.int_)
+        elif name == 'time_left':
+            return self.camp_time_left[self.camp]
+        elif name == 'created':
+            return self.camp_created[self.camp]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class ArrayQueue(BaseQueue):
+    """
+    A queue keeping the job attributes in column arrays.
+    Before each iteration the priorities are evaluated
+    at once by the `batch_priority` method of the scheduler.
+    Requires numpy.
+    """
+
+    _static = ('ID', 'submit', 'estimate', 'proc')
+
+    def __init__(self, *args):
+        BaseQueue.__init__(self, *args)
+        self._jobs = []
+        self._pos = {}
+        self._cols = {}
+        for name in self._static + ('user', 'camp'):
+            self._cols[name] = array('l')
+        self._users = _Slots()
+        self._camps = _Slots()
+
+    def add(self, job):
+        self._pos[job] = len(self._jobs)
+        self._jobs.append(job)
+        for name in self._static:
+            self._cols[name].append(getattr(job, name))
+        self._cols['user'].append(self._users.acquire(job.user))
+        self._cols['camp'].append(self._camps.acquire(job.camp))
+
+    def remove(self, job):
+        # move the last job to the freed position
+        i = self._pos.pop(job)
+        last = self._jobs.pop()
+        for col in self._cols.itervalues():
+            value = col.pop()
+            if last is not job:
+                col[i] = value
+        if last is not job:
+            self._jobs[i] = last
+            self._pos[last] = i
+        self._users.release(job.user)
+        self._camps.release(job.camp)
+
+    def ordered(self):
+        if not self._jobs:
+            return iter(())
+        keys = self._scheduler.batch_priority(BatchView(self))
+        if isinstance(keys, numpy.ndarray) and keys.ndim == 1:
+            order = numpy.argsort(keys, kind='mergesort')
+        else:
+            # the last key is the primary one in `lexsort`
+            order = numpy.lexsort(keys[::-1])
+        jobs = self._jobs
+        return (jobs[i] for i in order.tolist())
+
+    def __iter__(self):
+        return iter(self._jobs)
+
+    def __len__(self):
+        return len(self._jobs)
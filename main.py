@@ -10,7 +10,7 @@ import os
 import sys
 import time
 import zlib
-from core import parsers, simulator, spec_sim
+from core import cluster_managers, parsers, simulator, spec_sim
 from parts import settings
 
 
@@ -52,6 +52,10 @@ class Block(object):
         self.margin_count = len(self._jobs) - self.core_count
 
         self.number = num
+        # CPUs of each partition, if simulated separately
+        self.partitions = None
+        # capacity changes of each partition
+        self.capacity = None
 
     @property
     def core_period(self):
@@ -170,6 +174,18 @@ def cpu_percentile(block, percentile):
         raise Exception('invalid percentile %s' % percentile)
 
 
+def partition_cpus(block, percentile):
+    """
+    Return a dictionary with the number of CPUs for each partition,
+    based on the `cpu_percentile` of the partition jobs.
+    """
+    jobs = {}
+    for j in block:
+        jobs.setdefault(j.partition, []).append(j)
+    return {p: cpu_percentile(part_jobs, percentile)
+            for p, part_jobs in jobs.iteritems()}
+
+
 def remove_top(jobs, users, count):
     """
     Remove the jobs of the `count` most active users.
@@ -236,12 +252,15 @@ def print_runtime_stats(diag):
     diag.avg_util *= 100
 
     line0 = '    Backfilled jobs {bf_jobs:.2f}%, average utilization {avg_util:.2f}%'
-    line1 = '    Backfill loops {bf_pass}, sched loops {sched_pass}'
+    line1 = ('    Backfill loops {bf_pass} (skipped {bf_skipped}),'
+             ' sched loops {sched_pass} (skipped {sched_skipped})')
     line2 = '    Simulation time {sim_time:.2f}s, decay events {forced}'
+    line3 = '    Event queue peak {queue_peak}, dropped events {queue_dropped}'
 
     logging.info(line0.format(**vars(diag)))
     logging.info(line1.format(**vars(diag)))
     logging.info(line2.format(**vars(diag)))
+    logging.info(line3.format(**vars(diag)))
 
 
 def simulate_block(block, sched, alg_conf, part_conf):
@@ -358,18 +377,37 @@ def run(workload, args):
     # before we start, check the output directory
     if not os.path.isdir(sim_conf.output):
         raise Exception('invalid output directory %s' % sim_conf.output)
+    if sim_conf.partitions and sim_conf.cpu_count:
+        raise Exception('cpu_count cannot be used with partitions')
 
     # now we need to load and instantiate the classes from `part_conf`
     for key, value in part_conf.__dict__.items():
-        setattr(part_conf, key, make_classes(value, alg_conf))
+        if key == 'manager':
+            # created by each simulation for the block CPUs
+            part_conf.manager = cluster_managers.get_manager(value)
+        else:
+            setattr(part_conf, key, make_classes(value, alg_conf))
 
     # parse the workload
     my_parser = parsers.get_parser(workload)
     jobs, users = my_parser.parse_workload(workload, sim_conf.serial)
+    if sim_conf.capacity:
+        capacity = parsers.parse_capacity(sim_conf.capacity)
+    else:
+        capacity = None
 
     for job in jobs:
         job.submit = int(job.submit * sim_conf.time_factor)
 
+    if capacity and sim_conf.time_factor != 1:
+        # the timeline is scaled like the submit times
+        for part, changes in capacity.items():
+            scaled = {}
+            for when, change in changes:
+                when = int(when * sim_conf.time_factor)
+                scaled[when] = scaled.get(when, 0) + change
+            capacity[part] = sorted(scaled.iteritems())
+
     jobs.sort(key=lambda j: j.submit)  # order by submit time
 
     for j in jobs:
@@ -424,12 +462,18 @@ def run(workload, args):
 
     for bl in blocks:
         # calculate the CPU number
-        if sim_conf.cpu_count:
+        if sim_conf.partitions:
+            bl.partitions = partition_cpus(bl, sim_conf.cpu_percent)
+            cpus = sum(bl.partitions.itervalues())
+            logging.info('Block %s partition CPUs %s'
+                         % (bl.number, bl.partitions))
+        elif sim_conf.cpu_count:
             cpus = sim_conf.cpu_count
         else:
             cpus = cpu_percentile(bl, sim_conf.cpu_percent)
 
         bl.cpus = cpus
+        bl.capacity = capacity
 
         for sched in part_conf.schedulers:
             params = (bl, sched, alg_conf, part_conf)
@@ -25,12 +25,31 @@ class BaseScheduler(object):
       or the user/system CPU usage, respectively.
       This can result in about 10%-30% faster simulation.
 
+      If all the jobs from a campaign (or a user) share the same
+      priority, apart from a static ordering inside the group,
+      set the `priority_group` to 'campaign' (or 'user') and override:
+
+      1) group_priority_key
+      2) group_job_key
+
+      The simulator will then only sort the groups and merge
+      the jobs from the pre-sorted groups.
+
+      If the job priority never changes after the submission,
+      set the `static_priority` to True. The waiting jobs
+      will then be kept in a heap.
+
+      For large queues you can also override `batch_priority`
+      to evaluate all the priorities at once with numpy.
+
     """
 
     __metaclass__ = ABCMeta
 
     only_virtual = False
     only_real = False
+    priority_group = None
+    static_priority = False
 
     def __init__(self, settings):
         """
@@ -45,7 +64,11 @@ class BaseScheduler(object):
         run time statistics.
 
         Stats consist of:
-          cpu_used, active_shares, total_usage.
+          cpu_used, active_shares, total_usage, usage_scale.
+
+        Note:
+          The usage values are stored without the decay.
+          Use `user_usage` and `total_usage` to read them.
         """
         self._stats = stats
 
@@ -55,6 +78,18 @@ class BaseScheduler(object):
         """
         self._stats = None
 
+    def user_usage(self, user):
+        """
+        Return the user CPU usage with the decay applied.
+        """
+        return user.cpu_clock_used * self._stats.usage_scale
+
+    def total_usage(self):
+        """
+        Return the system CPU usage with the decay applied.
+        """
+        return self._stats.total_usage * self._stats.usage_scale
+
     @abstractmethod
     def job_priority_key(self, job):
         """
@@ -67,6 +102,36 @@ class BaseScheduler(object):
         """
         raise NotImplemented
 
+    def group_priority_key(self, group):
+        """
+        Create a comparison key for the whole `priority_group`,
+        i.e. a `Campaign` or a `User` instance.
+
+        Note:
+          The `job_priority_key` **MUST BE** equal to:
+            group_priority_key(group) + group_job_key(job)
+        """
+        raise NotImplemented
+
+    def group_job_key(self, job):
+        """
+        Create a comparison key to order the jobs inside a group.
+        The key **MUST NOT** change while the job is waiting.
+        """
+        raise NotImplemented
+
+    def batch_priority(self, view):
+        """
+        Vectorized version of the `job_priority_key`, used only
+        if numpy is available (see `waiting_queues.BatchView`
+        for the available columns).
+
+        Return a priority array or a sequence of arrays,
+        from the most significant one, compared like the
+        `job_priority_key` tuples.
+        """
+        raise NotImplemented
+
     def __str__(self):
         return self.__class__.__name__
 
@@ -77,6 +142,7 @@ class OStrich(BaseScheduler):
     """
 
     only_virtual = True
+    priority_group = 'campaign'
 
     def job_priority_key(self, job):
         """
@@ -90,36 +156,44 @@ class OStrich(BaseScheduler):
         Inside campaigns order by shorter run time estimate.
         In case of ties order by earlier submit.
         """
-        camp, user = job.camp, job.user
+        return self.group_priority_key(job.camp) + self.group_job_key(job)
+
+    def group_priority_key(self, camp):
+        user = camp.user
         end = camp.time_left / user.shares  # lower value -> higher priority
         # The `end` should be further multiplied by
         #   `_stats.active_shares` / `_stats.cpu_used`.
         # However, that gives the same value for all the jobs
         # and we only need the ordering, not the absolute value.
-        return (end, camp.created, user.ID, camp.ID,
-            job.estimate, job.submit, job.ID)
+        return (end, camp.created, user.ID, camp.ID)
 
+    def group_job_key(self, job):
+        return (job.estimate, job.submit, job.ID)
 
-class FifoOStrich(BaseScheduler):
+    def batch_priority(self, view):
+        return self._batch_camp_keys(view) + (view.estimate,
+                                              view.submit, view.ID)
+
+    def _batch_camp_keys(self, view):
+        end = view.time_left / view.shares[view.user]
+        return (end, view.created, view.user_id[view.user],
+                view.camp_id[view.camp])
+
+
+class FifoOStrich(OStrich):
     """
     Implementation of the OStrich algorithm.
     """
 
-    only_virtual = True
-
-    def job_priority_key(self, job):
+    def group_job_key(self, job):
         """
         Priority same as above, except jobs inside campaigns 
         are ordered only by the submit time.
         """
-        camp, user = job.camp, job.user
-        end = camp.time_left / user.shares  # lower value -> higher priority
-        # The `end` should be further multiplied by
-        #   `_stats.active_shares` / `_stats.cpu_used`.
-        # However, that gives the same value for all the jobs
-        # and we only need the ordering, not the absolute value.
-        return (end, camp.created, user.ID, camp.ID,
-            job.submit, job.ID)
+        return (job.submit, job.ID)
+
+    def batch_priority(self, view):
+        return self._batch_camp_keys(view) + (view.submit, view.ID)
 
 
 class Fairshare(BaseScheduler):
@@ -130,6 +204,7 @@ class Fairshare(BaseScheduler):
     """
 
     only_real = True
+    priority_group = 'user'
 
     def job_priority_key(self, job):
         """
@@ -150,14 +225,60 @@ class Fairshare(BaseScheduler):
           The new formula is as follows:
             pow(2.0, -((usage_efctv / shares_norm) / damp_factor))
         """
-        if not self._stats.total_usage:
+        return self.group_priority_key(job.user) + self.group_job_key(job)
+
+    def group_priority_key(self, user):
+        total = self.total_usage()
+        if not total:
             fairshare = 1
         else:
-            user = job.user
-            effective = user.cpu_clock_used / self._stats.total_usage
+            effective = self.user_usage(user) / total
             #shares_norm = user.shares  # already normalized
             fairshare = 2.0 ** -(effective / user.shares)
         prio = int(fairshare * 100000)  # higher value -> higher priority
         # TODO if needed change the constant to a configuration setting
         # TODO and add more components to the priority value
-        return (-prio, job.submit, job.ID)
+        return (-prio,)
+
+    def group_job_key(self, job):
+        return (job.submit, job.ID)
+
+    def batch_priority(self, view):
+        total = self.total_usage()
+        if not total:
+            return (view.submit, view.ID)  # equal fairshare
+        effective = view.cpu_clock_used * self._stats.usage_scale / total
+        fairshare = 2.0 ** -(effective / view.shares)
+        prio = (fairshare * 100000).astype(int)
+        return (-prio[view.user], view.submit, view.ID)
+
+
+class FCFS(BaseScheduler):
+    """
+    First come, first served.
+    """
+
+    only_real = True
+    static_priority = True
+
+    def job_priority_key(self, job):
+        """
+        Order by earlier submit.
+        """
+        return (job.submit, job.ID)
+
+
+class SJF(BaseScheduler):
+    """
+    Shortest job first.
+    """
+
+    only_real = True
+    static_priority = True
+
+    def job_priority_key(self, job):
+        """
+        Order by shorter run time estimate.
+        In case of ties order by earlier submit.
+        """
+        return (job.estimate, job.submit, job.ID)
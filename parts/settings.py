@@ -55,16 +55,43 @@ alg_templates = [
              loc='VirtualSelector'),
     Template('decay', 'The half-decay period of the CPU usage', 1, 'DAYS',
              loc='FairshareScheduler'),
+    Template('exact_decay', 'Integrate the decayed CPU usage exactly,'
+             ' instead of forcing periodic decay events', False,
+             loc='FairshareScheduler'),
     Template('default_limit', 'Default job time limit', 7, 'DAYS',
              loc='DefaultTimeSubmitter'),
     Template('share_file', 'File with user shares', 'shares.txt',
              loc='CustomShare'),
     Template('last_completed', 'The number of completed jobs to estimate'
              ' the time limit from', 2, loc='PreviousNEstimator'),
+    Template('node_cores', 'The number of CPUs in each node',
+             32, loc='NodeManager'),
+    Template('node_exclusive', 'Allocate whole nodes to the jobs',
+             False, loc='NodeManager'),
+    Template('sched_interval', 'The time between full scheduling passes,'
+             ' 0 to schedule only on job submissions and ends', 0, 'SEC'),
+    Template('default_queue_depth', 'The maximum number of jobs tested'
+             ' in the event triggered scheduling passes, 0 for no limit', 0),
     Template('bf_depth', 'The maximum number of jobs to backfill', 50),
     Template('bf_window', 'The amount of time to look into the future'
              ' when considering jobs for backfilling', 24, 'HOURS'),
+    Template('bf_resolution', 'The time grid for the planned job ends,'
+             ' 0 to plan with the exact time limits', 0, 'SEC'),
+    Template('bf_policy', 'The backfilling policy, conservative reserves'
+             ' resources for each tested job, easy only for the first'
+             ' one that cannot start (conservative or easy)',
+             'conservative'),
+    Template('bf_batch', 'Plan each backfilling pass at once'
+             ' with numpy', False),
     Template('bf_interval', 'The time between backfilling iterations', 5, 'MINS'),
+    Template('virtual_clock', 'Drive the virtual schedule by a global'
+             ' virtual clock, only touching the users that change', False),
+    Template('waiting_queue', 'The waiting job queue type, auto selects'
+             ' the fastest one supported by the scheduler'
+             ' (auto, list or array)',
+             'auto'),
+    Template('event_queue', 'The simulator event queue type'
+             ' (heap or calendar)', 'heap'),
     Template('update_time', 'The time interval of the simulation'
              ' progress display', 60, 'SEC'),
 ]
@@ -77,6 +104,9 @@ part_templates = [
     Template('schedulers', 'The scheduler classes',
              ['OStrich', 'Fairshare']),
     Template('share', 'The share assigner class', 'EqualShare'),
+    Template('manager', 'The cluster manager class (BaseManager,'
+             ' PersistentManager, TreeManager, NodeManager'
+             ' or CounterManager)', 'BaseManager'),
 ]
 
 sim_templates = [
@@ -94,7 +124,12 @@ sim_templates = [
     Template('pre_group', 'Group jobs into campaigns before submitting', False),
     Template('cpu_count', 'Set a static number of CPUs, takes precedence', 0),
     Template('cpu_percent', 'Set the number of CPUs to the P-th percentile', 70),
-    Template('time_factor', 'Multiply submission times by a factor', 1.0),
+    Template('partitions', 'Simulate each workload partition with its own'
+             ' CPUs, set to the `cpu_percent` of the partition jobs', False),
+    Template('capacity', 'A capacity timeline file with the down and up'
+             ' events of the CPUs', ''),
+    Template('time_factor', 'Multiply submission and capacity change times'
+             ' by a factor', 1.0),
     Template('output', 'Directory to store the results in', 'sim_results'),
 ]
 